@@ -0,0 +1,137 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from redis.exceptions import ConnectionError
+
+######################################################################
+# In-process LRU cache for decoded wishlists
+#   Entries expire after ttl seconds and are dropped as soon as a write
+#   to the same key is announced on a Redis pub/sub channel, by this
+#   process or any other one. Publishing ALL_KEYS drops every entry.
+######################################################################
+ALL_KEYS = '*'
+
+
+class LRUCache(object):
+	""" A thread-safe, size-bounded cache whose entries expire """
+
+	def __init__(self, max_size=1024, ttl=5.0):
+		self.max_size = max_size
+		self.ttl = ttl
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+		self._generation = 0
+		self._listener = None
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.invalidations = 0
+
+	def get(self, key):
+		with self._lock:
+			entry = self._entries.pop(key, None)
+			if entry is None or entry[0] < time.time():
+				self.misses += 1
+				return None
+			self._entries[key] = entry  # most recently used go last
+			self.hits += 1
+			return entry[1]
+
+	def generation(self):
+		"""
+		Returns a token to take before reading a value from the store and
+		to give back to put(), so that a value read before an invalidation
+		is not cached after it.
+		"""
+		return self._generation
+
+	def put(self, key, value, generation):
+		with self._lock:
+			if generation != self._generation:
+				return
+			self._entries.pop(key, None)
+			self._entries[key] = (time.time() + self.ttl, value)
+			while len(self._entries) > self.max_size:
+				self._entries.popitem(last=False)
+				self.evictions += 1
+
+	def invalidate(self, key):
+		with self._lock:
+			self._generation += 1
+			self.invalidations += 1
+			if key == ALL_KEYS:
+				self._entries.clear()
+			else:
+				self._entries.pop(key, None)
+
+	def clear(self):
+		self.invalidate(ALL_KEYS)
+
+	def stats(self):
+		with self._lock:
+			return {'size': len(self._entries), 'max_size': self.max_size, 'ttl': self.ttl,
+					'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+					'invalidations': self.invalidations}
+
+	def listen(self, redis, channel):
+		""" Starts dropping the keys published on channel, in a background thread """
+		self.stop_listening()
+		self._listener = InvalidationListener(self, redis, channel)
+		self._listener.start()
+
+	def stop_listening(self):
+		if self._listener is not None:
+			self._listener.stop()
+			self._listener = None
+
+
+class InvalidationListener(threading.Thread):
+	""" Subscribes to a channel and invalidates the keys published on it """
+
+	POLL_INTERVAL = 1.0
+
+	def __init__(self, cache, redis, channel):
+		super(InvalidationListener, self).__init__(name='cache-invalidation')
+		self.daemon = True
+		self.cache = cache
+		self.redis = redis
+		self.channel = channel
+		self._stopped = threading.Event()
+
+	def start(self):
+		# subscribe before returning so that no write made after listen() is missed
+		self._pubsub = self.subscribe()
+		super(InvalidationListener, self).start()
+
+	def subscribe(self):
+		try:
+			pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+			pubsub.subscribe(self.channel)
+		except ConnectionError:
+			return None
+		# writes published while we were not subscribed are lost
+		self.cache.clear()
+		return pubsub
+
+	def run(self):
+		pubsub = self._pubsub
+		while not self._stopped.is_set():
+			try:
+				if pubsub is None:
+					pubsub = self.subscribe()
+					if pubsub is None:
+						self._stopped.wait(self.POLL_INTERVAL)
+						continue
+				message = pubsub.get_message(timeout=self.POLL_INTERVAL)
+				if message is not None:
+					self.cache.invalidate(message['data'])
+			except ConnectionError:
+				logging.getLogger(__name__).warning('Lost the cache invalidation channel, retrying')
+				self.cache.clear()
+				pubsub = None
+		if pubsub is not None:
+			pubsub.close()
+
+	def stop(self):
+		self._stopped.set()
@@ -0,0 +1,113 @@
+import os
+import timeit
+import threading
+from flask import request
+from prometheus_client import CollectorRegistry, Counter, Histogram, Gauge, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+from . import app
+
+######################################################################
+# Request metrics in the Prometheus text format
+#   Every request is timed and sized by route template, so that the
+#   series stay few whatever the ids in the URLs. With several worker
+#   processes, set PROMETHEUS_MULTIPROC_DIR to an empty directory
+#   shared by them before they start: each process then writes its
+#   values there and /metrics adds up the values of all of them.
+######################################################################
+
+LATENCY = Histogram('http_request_duration_seconds', 'Time spent answering requests, by route and status',
+		['method', 'route', 'status'])
+IN_PROGRESS = Gauge('http_requests_in_progress', 'Requests being answered, by route',
+		['method', 'route'], multiprocess_mode='livesum')
+SIZE_BUCKETS = (100, 300, 1000, 3000, 10000, 30000, 100000, 300000, 1000000, 3000000, float('inf'))
+REQUEST_SIZE = Histogram('http_request_size_bytes', 'Size of the request bodies, by route',
+		['method', 'route'], buckets=SIZE_BUCKETS)
+RESPONSE_SIZE = Histogram('http_response_size_bytes', 'Size of the response bodies, by route and status',
+		['method', 'route', 'status'], buckets=SIZE_BUCKETS)
+
+REDIS_LATENCY = Histogram('redis_command_duration_seconds', 'Time spent in round trips to the storage, by command',
+		['command'], buckets=(.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, float('inf')))
+REDIS_COMMANDS = Counter('redis_commands_total', 'Commands sent to the storage, pipelined ones included', ['command'])
+REDIS_BYTES = Counter('redis_command_bytes_total', 'Bytes of the arguments sent and of the replies received, by command',
+		['command', 'direction'])
+REDIS_CALLS = Histogram('http_request_redis_calls', 'Round trips to the storage made by each request, by route',
+		['method', 'route'], buckets=(0, 1, 2, 3, 4, 5, 7, 10, 15, 20, 30, 50, 100, float('inf')))
+
+# kept in the environ of the request, as the requests of a /batch share g
+STARTED = 'wishlists.metrics.started'
+REDIS_USAGE = 'wishlists.metrics.redis'
+
+# the Redis usage of the requests being answered by each thread: the
+# requests of a /batch run inside it and count towards it as well
+answering = threading.local()
+
+
+def multiprocess_dir():
+	return os.getenv('PROMETHEUS_MULTIPROC_DIR') or os.getenv('prometheus_multiproc_dir')
+
+
+def route():
+	""" The template of the route of the request, like /wishlists/<int:wishlist_id> """
+	return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+@app.before_request
+def start_timer():
+	request.environ[STARTED] = (timeit.default_timer(), route())
+	IN_PROGRESS.labels(request.method, route()).inc()
+	usage = request.environ[REDIS_USAGE] = {'calls': 0, 'commands': {}, 'seconds': 0.0, 'bytes': 0}
+	answering.__dict__.setdefault('usages', []).append(usage)
+
+
+@app.after_request
+def record_request(response):
+	started = request.environ.get(STARTED)
+	if started is not None:
+		status = str(response.status_code)
+		LATENCY.labels(request.method, started[1], status).observe(timeit.default_timer() - started[0])
+		REQUEST_SIZE.labels(request.method, started[1]).observe(request.content_length or 0)
+		if not response.is_streamed:
+			RESPONSE_SIZE.labels(request.method, started[1], status).observe(response.calculate_content_length() or 0)
+	usage = request.environ.get(REDIS_USAGE)
+	if usage is not None:
+		REDIS_CALLS.labels(request.method, started[1] if started else route()).observe(usage['calls'])
+		response.headers['X-Redis-Calls'] = str(usage['calls'])
+		response.headers['X-Redis-Time'] = '%.3f' % (usage['seconds'] * 1000)
+		response.headers['X-Redis-Bytes'] = str(usage['bytes'])
+		app.logger.info('%s %s %s: %d Redis calls (%s) in %.3f ms, %d bytes', request.method, request.path,
+				response.status_code, usage['calls'], ', '.join('%s x%d' % command for command in sorted(usage['commands'].iteritems())),
+				usage['seconds'] * 1000, usage['bytes'])
+	return response
+
+
+@app.teardown_request
+def finish_request(exception):
+	started = request.environ.pop(STARTED, None)
+	if started is not None:
+		IN_PROGRESS.labels(request.method, started[1]).dec()
+	usage = request.environ.pop(REDIS_USAGE, None)
+	usages = getattr(answering, 'usages', [])
+	if usages and usages[-1] is usage:
+		usages.pop()
+
+
+def record_command(command, seconds, sent, received, commands):
+	""" Records a round trip to the storage, for the InstrumentedBackend the model uses """
+	REDIS_LATENCY.labels(command).observe(seconds)
+	REDIS_COMMANDS.labels(command).inc(commands)
+	REDIS_BYTES.labels(command, 'sent').inc(sent)
+	REDIS_BYTES.labels(command, 'received').inc(received)
+	for usage in getattr(answering, 'usages', []):
+		usage['calls'] += 1
+		usage['commands'][command] = usage['commands'].get(command, 0) + 1
+		usage['seconds'] += seconds
+		usage['bytes'] += sent + received
+
+
+def exposition():
+	""" Returns the metrics of this process, or of all the workers, and their content type """
+	registry = REGISTRY
+	if multiprocess_dir():
+		registry = CollectorRegistry()
+		multiprocess.MultiProcessCollector(registry)
+	return generate_latest(registry), CONTENT_TYPE_LATEST
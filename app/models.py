@@ -1,19 +1,55 @@
-import pickle
+import time
+import base64
 from flask import url_for
 from werkzeug.exceptions import NotFound
+from redis.exceptions import ResponseError
 from custom_exceptions import DataValidationError, ItemNotFoundException, WishlistNotFoundException
 import json
 from datetime import datetime
-import pickle
+import serialization
+import search_index
+from cache import ALL_KEYS
 ######################################################################
 # Wishlist Model for database
-#   This class must be initialized with use_db(redis) before using
-#   where redis is a value connection to a Redis database
+#   This class must be initialized with use_db(db) before using
+#   where db is a storage backend, see storage.py: a connection to a
+#   Redis database or an in-memory store offering the same commands
+#
+#   Each wishlist is stored as a Redis hash under its id:
+#     meta          encoded name, user_id, created and deleted
+#     owner         user_id the wishlist is indexed under
+#     item_seq      last item position handed out
+#     version       bumped by every change, served as the ETag
+#     item:<id>     encoded item
+#     pos:<id>      insertion-order position of the item
+#     tok:<id>      search terms the item is indexed under
+#   so that item writes touch only the fields of that item. Encoded
+#   fields are written with the codec chosen by use_codec(name), see
+#   serialization.py; fields written by any other codec are still read.
+#   Wishlists saved as a single pickled string by older releases are
+#   still read and are rewritten as a hash the first time they are read.
+#
+#   Other keys:
+#     index                    last wishlist id handed out
+#     wishlist_ids             sorted set of every wishlist id, for paging
+#     user_wishlists:<user>    ids of the wishlists of a user
+#     search:<user>:<term>     <wishlist id>:<item id> of the items of a
+#                              user found by a term, see search_index.py
+#
+#   Reads of single wishlists may be served from an in-process cache set
+#   with use_cache(cache); every write publishes the id of the wishlist
+#   on CACHE_CHANNEL so that the caches of all processes drop it.
 ######################################################################
 class Wishlist(object):
-	__redis = None
+	__db = None
+	__codec = serialization.get_codec('json')
+	__scripts = {}
+	__cache = None
+	CACHE_CHANNEL = 'wishlists:invalidate'
 	UPDATABLE_WISHLIST_FIELDS = ['user_id', 'name']
 	UPDATABLE_ITEM_FIELDS = ['description']
+	SCAN_BATCH_SIZE = 500
+	MAX_PAGE_SIZE = 1000
 	def __init__(self,id=0,name=None,user_id=None,items={}):
 		"""
 		Initializes the internal store of wishlist resources.
@@ -24,6 +60,10 @@ class Wishlist(object):
 		self.user_id = str(user_id)
 		self.items = {}
 		self.deleted = False
+		self.version = 0
+		self.__owner = None
+		self.__last_position = 0
+		self.__items_replaced = True
 
 	def self_url(self):
 		return url_for('read_wishlist', wishlist_id=self.id, _external=True)
@@ -31,71 +71,87 @@ class Wishlist(object):
 	def save_wishlist(self):
 		if self.id==0:
 			self.id = self.__next_index()
-		Wishlist.__redis.set(self.id, pickle.dumps(self.serialize_wishlist()))
+		# keep the hash and the indexes in step with MULTI/EXEC
+		pipe = Wishlist.__db.pipeline()
+		version = self.__queue_save(pipe)
+		self.__saved(pipe.execute()[version])
 
-	def save_item(self):
-		Wishlist.__redis.set(self.id, pickle.dumps(self.serialize_wishlist()))
+	def __queue_save(self, pipe):
+		"""
+		Queues the commands saving the wishlist on pipe and returns the
+		position of the reply holding its new version.
+		"""
+		fields = {}
+		if self.__items_replaced:
+			Wishlist.__scripts['reset_items'](keys=[self.id], client=pipe)
+			fields['item_seq'] = self.__last_position
+			for item_id, item in self.items.iteritems():
+				fields.update(self.__item_fields(item_id))
+				terms = search_index.index_terms(item)
+				fields['tok:%s' % item_id] = ' '.join(terms)
+				for term in terms:
+					pipe.sadd(Wishlist.__search_key(self.user_id, term), '%s:%s' % (self.id, item_id))
+		elif self.__owner is not None and self.__owner != self.user_id:
+			Wishlist.__scripts['move_search_index'](keys=[self.id], args=[self.user_id], client=pipe)
+		fields['meta'] = Wishlist.__codec.encode({'name':self.name, 'user_id':self.user_id, 'created':self.created, 'deleted':self.deleted})
+		fields['owner'] = self.user_id
+		pipe.hmset(self.id, fields)
+		version = len(pipe)
+		pipe.hincrby(self.id, 'version', 1)
+		if self.__owner is not None and self.__owner != self.user_id:
+			pipe.srem(Wishlist.__user_key(self.__owner), self.id)
+		pipe.sadd(Wishlist.__user_key(self.user_id), self.id)
+		pipe.zadd('wishlist_ids', self.id, self.id)
+		pipe.publish(Wishlist.CACHE_CHANNEL, self.id)
+		return version
+
+	def __saved(self, version):
+		self.version = version
+		Wishlist.__invalidate(self.id)
+		self.__owner = self.user_id
+		self.__items_replaced = False
+
+	def __item_fields(self, item_id):
+		item = self.items[item_id]
+		return {'item:%s' % item_id:Wishlist.__codec.encode({'item_id':item['item_id'], 'description':item['description']}),
+				'pos:%s' % item_id:item['position']}
 
 	def all_items(self):
 		return self.items
 
 	def find_item(self, item_id):
-		temp_items = self.items
-		return_item = None
-		for key,value in temp_items.iteritems():
-			if item_id == value['item_id']:
-				return_item = temp_items[key]
-		if return_item:
-			return return_item
+		item = self.items.get(item_id)
+		if item:
+			return item
 		else:
 			raise ItemNotFoundException
 
 	def update_item(self, data):
-		temp_items = self.items
-		update_item = None
-		for key,value in temp_items.iteritems():
-			if data['id'] == value['item_id']:
-				update_item = temp_items[key]
-		if update_item:
-			update_item['description'] = data['description']
-			self.items = temp_items
+		item = self.items.get(data['id'])
+		if item:
+			item['description'] = data['description']
 			return self.serialize_wishlist()
 		else:
 			raise ItemNotFoundException
 
 	def remove_item(self, item_id):
-		temp_items = self.items
-		remove_item = None
 		if item_id is None:
-			keys = []
-			for key,value in temp_items.iteritems():
-				keys.append(key)
-			for key in keys:
-				temp_items.pop(key)
-			self.items = temp_items
+			self.items = {}
+			self.__items_replaced = True
+		elif item_id in self.items:
+			self.items.pop(item_id)
 		else:
-			for key,value in temp_items.iteritems():
-				if item_id == value['item_id']:
-					remove_item = temp_items[key]
-					remove_key = key
-			if remove_item:
-				temp_items.pop(remove_key)
-				self.items = temp_items
-			else:
-				raise ItemNotFoundException
+			raise ItemNotFoundException
 
 	def search_items(self, data):
 		return_items=[]
 		#If no data is present, returning all the products of the user.
 		if data['uid']==self.user_id:
-			temp_items = self.items
-			for key,value in temp_items.iteritems():
+			for value in sorted(self.items.itervalues(), key=lambda item: item['position']):
 				if data['query'] is None:
 					return_items.append(value)
-				else:
-					for k2,v2 in value.iteritems():
-						if data['query'] in v2 and value not in return_items:
-							return_items.append(value)
+				elif search_index.matches(value, data['query']):
+					return_items.append(value)
 			if return_items:
 				message = "Results from wishlist with ID %s" % self.id
 				wl = {message:return_items}
@@ -106,10 +162,17 @@ class Wishlist(object):
 	 		return None
 
 	def delete(self):
-		Wishlist.__redis.delete(self.id)
+		pipe = Wishlist.__db.pipeline()
+		Wishlist.__scripts['move_search_index'](keys=[self.id], args=[''], client=pipe)
+		pipe.delete(self.id)
+		pipe.srem(Wishlist.__user_key(self.user_id), self.id)
+		pipe.zrem('wishlist_ids', self.id)
+		pipe.publish(Wishlist.CACHE_CHANNEL, self.id)
+		pipe.execute()
+		Wishlist.__invalidate(self.id)
 
 	def __next_index(self):
-		return Wishlist.__redis.incr('index')
+		return Wishlist.__db.incr('index')
 
 	def serialize_wishlist(self):
 		return {"id":self.id, "user_id":self.user_id, "name":self.name, "items":self.items, "created":self.created, "deleted":self.deleted}
@@ -121,14 +184,9 @@ class Wishlist(object):
 		try:
 			self.name = self.name
 			self.user_id = self.user_id
-			temp_items = self.items
-			if not temp_items:
-				temp_items[1] = {'item_id':data['id'], 'description':data['description']}
-			else:
-				if data['id'] not in temp_items.values():
-					size = len(temp_items) + 1
-					temp_items[size] = {'item_id':data['id'], 'description':data['description']}
-					self.items = temp_items
+			if data['id'] not in self.items:
+				self.__last_position += 1
+				self.items[data['id']] = {'item_id':data['id'], 'description':data['description'], 'position':self.__last_position}
 			self.created = self.created
 			self.deleted = self.deleted
 		except KeyError as ke:
@@ -144,7 +202,9 @@ class Wishlist(object):
 			if 'items' not in data:
 				self.items = self.items
 			else:
-				self.items = data['items']
+				self.items = Wishlist.migrate_items(data['items'])
+				self.__items_replaced = True
+				self.__last_position = max([item['position'] for item in self.items.itervalues()] or [0])
 			self.created = str(datetime.utcnow())
 			self.deleted = self.deleted
 		except KeyError as ke:
@@ -158,36 +218,778 @@ class Wishlist(object):
 ######################################################################
 
 	@staticmethod
-	def use_db(redis):
-		Wishlist.__redis = redis
+	def use_db(db):
+		Wishlist.__db = db
+		if db is not None:
+			Wishlist.__scripts = dict((name, db.register_script(source, FALLBACKS[name])) for name, source in SCRIPTS.iteritems())
+
+	@staticmethod
+	def use_codec(name):
+		Wishlist.__codec = serialization.get_codec(name)
+
+	@staticmethod
+	def use_cache(cache):
+		"""
+		Serves find() from cache, an LRUCache, or from Redis only when it
+		is None. The cache listens for the writes of other processes.
+		"""
+		if Wishlist.__cache is not None:
+			Wishlist.__cache.stop_listening()
+		Wishlist.__cache = cache
+		if cache is not None and Wishlist.__db is not None:
+			cache.listen(Wishlist.__db, Wishlist.CACHE_CHANNEL)
+
+	@staticmethod
+	def cache_stats():
+		if Wishlist.__cache is None:
+			return None
+		return Wishlist.__cache.stats()
+
+	@staticmethod
+	def __invalidate(id):
+		if Wishlist.__cache is not None:
+			Wishlist.__cache.invalidate(str(id))
+
+	@staticmethod
+	def migrate_items(items):
+		"""
+		Returns items keyed by their item_id with an insertion-order position.
+		Items stored in the old layout, keyed by a sequential counter, are
+		converted in counter order; the first copy of a duplicated item wins.
+		"""
+		migrated = {}
+		legacy = []
+		for key, value in items.iteritems():
+			if key == value['item_id'] and 'position' in value:
+				migrated[key] = value
+			else:
+				legacy.append((int(key) if str(key).isdigit() else key, value))
+		if legacy:
+			position = max([item['position'] for item in migrated.itervalues()] or [0])
+			for key, value in sorted(legacy):
+				if value['item_id'] not in migrated:
+					position += 1
+					migrated[value['item_id']] = {'item_id':value['item_id'], 'description':value['description'], 'position':position}
+		return migrated
 
 	@staticmethod
 	def remove_all():
-		Wishlist.__redis.flushall()
+		Wishlist.__db.flushall()
+		Wishlist.__db.publish(Wishlist.CACHE_CHANNEL, ALL_KEYS)
+		Wishlist.__invalidate(ALL_KEYS)
 
 	@staticmethod
-	def all():
-		results = []
-		for key in Wishlist.__redis.keys():
-			if key != 'index':  # filer out our id index
-				data = Wishlist.__redis.get(key)
-				pickled_data = pickle.loads(data)
-				wl = Wishlist(pickled_data['id']).deserialize_wishlist(pickled_data)
-				results.append(wl)
-		return results
+	def scan(cursor=0, count=None):
+		"""
+		Walks one step of the keyspace with SCAN and returns the next cursor
+		together with the wishlists found in that step, fetched in one pipeline.
+		"""
+		if count is None:
+			count = Wishlist.SCAN_BATCH_SIZE
+		cursor, keys = Wishlist.__db.scan(cursor, match='[0-9]*', count=count)
+		keys = [key for key in keys if key.isdigit()]  # filter out our id index
+		return cursor, Wishlist.__fetch(keys)
+
+	@staticmethod
+	def all(batch_size=None):
+		"""
+		Lazily yields every wishlist, walking the keyspace in batches so that
+		Redis is never blocked by KEYS and each batch costs a single round trip.
+		"""
+		seen = set()
+		cursor = 0
+		while True:
+			cursor, wishlists = Wishlist.scan(cursor, batch_size)
+			for wl in wishlists:
+				# SCAN may return a key more than once while Redis rehashes
+				if wl.id not in seen:
+					seen.add(wl.id)
+					yield wl
+			if cursor == 0:
+				break
+
+	@staticmethod
+	def page(cursor=None, limit=MAX_PAGE_SIZE):
+		"""
+		Returns up to limit wishlists in id order, starting after the
+		position encoded in cursor, and the cursor of the next page or None
+		when this page is the last. Cursors stay valid while wishlists are
+		created and deleted.
+		"""
+		after = Wishlist.__decode_cursor(cursor) if cursor else 0
+		ids = Wishlist.__db.zrangebyscore('wishlist_ids', '(%d' % after, '+inf', start=0, num=limit + 1)
+		next_cursor = None
+		if len(ids) > limit:
+			ids = ids[:limit]
+			next_cursor = base64.urlsafe_b64encode('id:%s' % ids[-1])
+		return Wishlist.__fetch(ids), next_cursor
+
+	@staticmethod
+	def __decode_cursor(cursor):
+		try:
+			kind, id = base64.urlsafe_b64decode(str(cursor)).split(':')
+			if kind != 'id':
+				raise ValueError
+			return int(id)
+		except (TypeError, ValueError):
+			raise DataValidationError('Invalid cursor: %s' % cursor)
+
+	@staticmethod
+	def version_of(id):
+		"""
+		Returns the version of wishlist id without reading the wishlist,
+		or None when it does not exist or is still stored as a single blob.
+		"""
+		try:
+			version = Wishlist.__db.hget(id, 'version')
+		except ResponseError:
+			return None
+		return int(version) if version is not None else None
 
 	@staticmethod
 	def find(id):
-		if Wishlist.__redis.exists(id):
-				data = pickle.loads(Wishlist.__redis.get(id))
-				wl = Wishlist(data['id']).deserialize_wishlist(data)
-				return wl
+		cache = Wishlist.__cache
+		if cache is not None:
+			key = str(id)
+			wl = cache.get(key)
+			if wl is not None:
+				return wl.__copy()
+			generation = cache.generation()
+		wishlists = Wishlist.__fetch([id])
+		if wishlists:
+			if cache is not None:
+				cache.put(key, wishlists[0].__copy(), generation)
+			return wishlists[0]
 		else:
 			return None
 
+	@staticmethod
+	def find_many(ids):
+		"""
+		Returns the wishlists among ids that exist, in the order of ids,
+		serving what it can from the cache and reading the rest in a
+		single pipelined round trip.
+		"""
+		cache = Wishlist.__cache
+		found = {}
+		unread = ids
+		if cache is not None:
+			generation = cache.generation()
+			unread = []
+			for id in ids:
+				wl = cache.get(str(id))
+				if wl is None:
+					unread.append(id)
+				else:
+					found[int(id)] = wl.__copy()
+		for wl in Wishlist.__fetch(unread):
+			found[wl.id] = wl
+			if cache is not None:
+				cache.put(str(wl.id), wl.__copy(), generation)
+		return [found[int(id)] for id in ids if int(id) in found]
+
+	def __copy(self):
+		""" Returns a copy that can be changed without changing the cached wishlist """
+		wl = Wishlist(self.id, self.name)
+		wl.user_id = self.user_id
+		wl.created = self.created
+		wl.deleted = self.deleted
+		wl.version = self.version
+		wl.items = dict((item_id, dict(item)) for item_id, item in self.items.iteritems())
+		wl.__owner = self.__owner
+		wl.__last_position = self.__last_position
+		wl.__items_replaced = self.__items_replaced
+		return wl
+
+	@staticmethod
+	def find_by_user(user_id):
+		"""
+		Returns the wishlists owned by user_id using the per-user index,
+		so the cost depends on that user's wishlists only.
+		"""
+		return Wishlist.__fetch(list(Wishlist.__db.smembers(Wishlist.__user_key(user_id))))
+
+	@staticmethod
+	def search(user_id, query):
+		"""
+		Returns (wishlist, items) pairs for the wishlists of user_id having
+		items that match query, answered from the search index. When query
+		is None every item of the user is returned.
+		"""
+		if query is None:
+			wishlists = Wishlist.find_by_user(user_id)
+		else:
+			terms = search_index.query_terms(query)
+			if not terms:
+				return []
+			matches = {}
+			for member in Wishlist.__db.sinter([Wishlist.__search_key(user_id, term) for term in terms]):
+				id, item_id = member.decode('utf-8').split(':', 1)
+				matches.setdefault(int(id), set()).add(item_id)
+			wishlists = Wishlist.__fetch(sorted(matches))
+		results = []
+		for wl in sorted(wishlists, key=lambda wl: wl.id):
+			if query is None:
+				items = wl.items.values()
+			else:
+				# the index may run ahead of the wishlists read, so check each item
+				items = [item for item_id, item in wl.items.iteritems()
+						if u'%s' % item_id in matches[wl.id] and search_index.matches(item, query)]
+			if items:
+				results.append((wl, sorted(items, key=lambda item: item['position'])))
+		return results
+
+	@staticmethod
+	def save_all(wishlists):
+		"""
+		Saves many wishlists at once, reserving the ids of the new ones
+		with a single INCRBY and writing them all in one MULTI/EXEC.
+		"""
+		new = [wl for wl in wishlists if wl.id == 0]
+		if new:
+			last = Wishlist.__db.incrby('index', len(new))
+			for id, wl in zip(range(last - len(new) + 1, last + 1), new):
+				wl.id = id
+		pipe = Wishlist.__db.pipeline()
+		versions = [wl.__queue_save(pipe) for wl in wishlists]
+		results = pipe.execute()
+		for wl, version in zip(wishlists, versions):
+			wl.__saved(results[version])
+		return wishlists
+
+	@staticmethod
+	def store_item(id, data):
+		"""
+		Adds an item to wishlist id in a single round trip and returns the
+		updated wishlist. Adding an item that is already there changes nothing.
+		"""
+		try:
+			item = {'item_id':data['id'], 'description':data['description']}
+		except KeyError as ke:
+			raise DataValidationError('Invalid item: missing ' + ke.args[0])
+		except TypeError as te:
+			raise DataValidationError('Invalid item: body of request contained bad or no data')
+		return Wishlist.__run_item_script('add_item', id, item['item_id'], Wishlist.__codec.encode(item), *search_index.index_terms(item))
+
+	@staticmethod
+	def store_items(id, items):
+		"""
+		Adds many items to wishlist id in a single round trip. Returns the
+		updated wishlist and, for each item, whether it was added; items
+		that are already there, even earlier in items, are left unchanged.
+		"""
+		args = []
+		for data in items:
+			try:
+				item = {'item_id':data['id'], 'description':data['description']}
+			except KeyError as ke:
+				raise DataValidationError('Invalid item: missing ' + ke.args[0])
+			except TypeError as te:
+				raise DataValidationError('Invalid item: body of request contained bad or no data')
+			terms = search_index.index_terms(item)
+			args.extend([item['item_id'], Wishlist.__codec.encode(item), len(terms)] + terms)
+		result = Wishlist.__eval_item_script('add_items', id, *args)
+		wl = Wishlist.__from_hash(id, dict(zip(result[1][::2], result[1][1::2])))
+		return wl, [added == 1 for added in result[2]]
+
+	@staticmethod
+	def replace_item(id, data):
+		"""
+		Replaces the description of an item of wishlist id in a single round
+		trip and returns the updated wishlist.
+		"""
+		try:
+			item = {'item_id':data['id'], 'description':data['description']}
+		except KeyError as ke:
+			raise DataValidationError('Invalid item: missing ' + ke.args[0])
+		except TypeError as te:
+			raise DataValidationError('Invalid item: body of request contained bad or no data')
+		return Wishlist.__run_item_script('update_item', id, item['item_id'], Wishlist.__codec.encode(item), *search_index.index_terms(item))
+
+	@staticmethod
+	def delete_item(id, item_id):
+		""" Removes an item from wishlist id in a single round trip """
+		Wishlist.__run_item_script('remove_item', id, item_id)
+
+	@staticmethod
+	def clear_items(id):
+		""" Removes every item of wishlist id and returns the emptied wishlist """
+		return Wishlist.__run_item_script('clear_items', id)
+
+	@staticmethod
+	def __run_item_script(name, id, *args):
+		"""
+		Runs one of the item scripts, which check, change and read back the
+		wishlist atomically, and returns the wishlist they read back.
+		"""
+		result = Wishlist.__eval_item_script(name, id, *args)
+		if len(result) > 1:
+			return Wishlist.__from_hash(id, dict(zip(result[1][::2], result[1][1::2])))
+
+	@staticmethod
+	def __eval_item_script(name, id, *args):
+		""" Runs one of the item scripts and turns its status into the model's exceptions """
+		result = Wishlist.__scripts[name](keys=[id], args=args)
+		if result[0] == 'legacy':
+			# stored as a single blob, rewrite it as a hash and try again
+			Wishlist.find(id)
+			result = Wishlist.__scripts[name](keys=[id], args=args)
+		if result[0] == 'missing':
+			raise WishlistNotFoundException
+		if result[0] == 'no_item':
+			raise ItemNotFoundException
+		Wishlist.__invalidate(id)
+		return result
+
+	@staticmethod
+	def reencode(batch_size=None, pause=0):
+		"""
+		Rewrites the encoded fields that were not written by the current
+		codec, one SCAN batch at a time, sleeping pause seconds between
+		batches to leave room for live traffic. Each field is only replaced
+		if it still holds the value that was read, so concurrent writes
+		are never lost. Returns the number of fields rewritten.
+		"""
+		rewritten = 0
+		cursor = 0
+		while True:
+			cursor, keys = Wishlist.__db.scan(cursor, match='[0-9]*', count=batch_size or Wishlist.SCAN_BATCH_SIZE)
+			keys = [key for key in keys if key.isdigit()]
+			pipe = Wishlist.__db.pipeline(transaction=False)
+			for key in keys:
+				pipe.hgetall(key)
+			for key, fields in zip(keys, pipe.execute(raise_on_error=False)):
+				if isinstance(fields, ResponseError):
+					Wishlist.find(key)  # stored as a single blob, rewritten on read
+					continue
+				changes = []
+				for field, value in fields.iteritems():
+					if (field == 'meta' or field.startswith('item:')) and not Wishlist.__codec.owns(value):
+						changes.extend([field, value, Wishlist.__codec.encode(serialization.decode(value))])
+				if changes:
+					rewritten += Wishlist.__scripts['compare_and_set'](keys=[key], args=changes)
+			if cursor == 0:
+				break
+			time.sleep(pause)
+		return rewritten
+
+	@staticmethod
+	def reindex():
+		"""
+		Rebuilds the id, per-user and search indexes from the stored
+		wishlists, for data written before the indexes existed.
+		"""
+		for wl in Wishlist.all():
+			wl.__items_replaced = True
+			wl.save_wishlist()
+
+	@staticmethod
+	def __user_key(user_id):
+		return 'user_wishlists:%s' % user_id
+
+	@staticmethod
+	def __search_key(user_id, term):
+		return u'search:%s:%s' % (user_id, term)
+
+	@staticmethod
+	def __fetch(ids):
+		"""
+		Reads the given wishlists with one pipelined HGETALL per id, skipping
+		ids that do not exist. Wishlists still stored as a pickled string are
+		read with a second MGET and rewritten as hashes.
+		"""
+		if not ids:
+			return []
+		pipe = Wishlist.__db.pipeline(transaction=False)
+		for id in ids:
+			pipe.hgetall(id)
+		results = pipe.execute(raise_on_error=False)
+		legacy = []
+		for id, fields in zip(ids, results):
+			if isinstance(fields, ResponseError):
+				if not str(fields).startswith('WRONGTYPE'):
+					raise fields
+				legacy.append(id)
+		blobs = dict(zip(legacy, Wishlist.__db.mget(legacy))) if legacy else {}
+		wishlists = []
+		for id, fields in zip(ids, results):
+			if blobs.get(id) is not None:
+				wl = Wishlist.__from_blob(blobs[id])
+				wl.save_wishlist()
+				wishlists.append(wl)
+			elif fields:
+				wishlists.append(Wishlist.__from_hash(id, fields))
+		return wishlists
+
+	@staticmethod
+	def __from_hash(id, fields):
+		meta = serialization.decode(fields['meta'])
+		wl = Wishlist(id, meta['name'])
+		wl.user_id = meta['user_id']
+		wl.created = meta['created']
+		wl.deleted = meta['deleted']
+		for field, value in fields.iteritems():
+			if field.startswith('item:'):
+				item = serialization.decode(value)
+				item['position'] = int(fields['pos:' + field[5:]])
+				wl.items[item['item_id']] = item
+		wl.__last_position = int(fields.get('item_seq', 0))
+		wl.version = int(fields.get('version', 0))
+		wl.__owner = fields['owner']
+		wl.__items_replaced = False
+		return wl
+
+	@staticmethod
+	def __from_blob(blob):
+		data = serialization.decode(blob)
+		wl = Wishlist(data['id']).deserialize_wishlist(data)
+		wl.created = data['created']
+		return wl
+
 	@staticmethod
 	def find_or_404(id):
 		wishlist = Wishlist.find(id)
 		if not wishlist:
 			raise WishlistNotFoundException
 		return wishlist
+
+
+######################################################################
+#  L U A   S C R I P T S
+######################################################################
+
+SCRIPTS = {}
+
+# ARGV holds (field, expected, new) triples; a field is only replaced if it
+# still holds the expected value. Returns the number of fields replaced.
+SCRIPTS['compare_and_set'] = """
+local replaced = 0
+for i = 1, #ARGV, 3 do
+	if redis.call('HGET', KEYS[1], ARGV[i]) == ARGV[i + 1] then
+		redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 2])
+		replaced = replaced + 1
+	end
+end
+if replaced > 0 then
+	redis.call('PUBLISH', '%(channel)s', KEYS[1])
+end
+return replaced
+"""
+
+# The item scripts take the wishlist key as KEYS[1] and return a status,
+# followed by the wishlist's fields when the change succeeded:
+#   missing   the wishlist does not exist
+#   legacy    the wishlist is still stored as a single blob
+#   no_item   the item does not exist
+#   ok        the change was made
+SEARCH_INDEX = """
+local function unindex(owner, item_id)
+	local terms = redis.call('HGET', KEYS[1], 'tok:' .. item_id)
+	if terms then
+		for term in string.gmatch(terms, '%S+') do
+			redis.call('SREM', 'search:' .. owner .. ':' .. term, KEYS[1] .. ':' .. item_id)
+		end
+		redis.call('HDEL', KEYS[1], 'tok:' .. item_id)
+	end
+end
+
+-- indexes the item under the terms in ARGV[first], ..., ARGV[last or #ARGV]
+local function index(owner, item_id, first, last)
+	last = last or #ARGV
+	for i = first, last do
+		redis.call('SADD', 'search:' .. owner .. ':' .. ARGV[i], KEYS[1] .. ':' .. item_id)
+	end
+	redis.call('HSET', KEYS[1], 'tok:' .. item_id, table.concat(ARGV, ' ', first, last))
+end
+"""
+
+CHECK_WISHLIST = """
+local kind = redis.call('TYPE', KEYS[1])['ok']
+if kind == 'none' then
+	return {'missing'}
+elseif kind ~= 'hash' then
+	return {'legacy'}
+end
+"""
+
+# ARGV: item_id, encoded item, search terms...
+SCRIPTS['add_item'] = SEARCH_INDEX + CHECK_WISHLIST + """
+if redis.call('HEXISTS', KEYS[1], 'item:' .. ARGV[1]) == 0 then
+	local position = redis.call('HINCRBY', KEYS[1], 'item_seq', 1)
+	redis.call('HMSET', KEYS[1], 'item:' .. ARGV[1], ARGV[2], 'pos:' .. ARGV[1], position)
+	index(redis.call('HGET', KEYS[1], 'owner'), ARGV[1], 3)
+	redis.call('HINCRBY', KEYS[1], 'version', 1)
+	redis.call('PUBLISH', '%(channel)s', KEYS[1])
+end
+return {'ok', redis.call('HGETALL', KEYS[1])}
+"""
+
+# ARGV: item_id, encoded item, number of search terms, search terms... for
+# each item. Also returns 1 for each item that was added, 0 for the others.
+SCRIPTS['add_items'] = SEARCH_INDEX + CHECK_WISHLIST + """
+local owner = redis.call('HGET', KEYS[1], 'owner')
+local added = {}
+local changed = false
+local i = 1
+while i <= #ARGV do
+	local last = i + 2 + tonumber(ARGV[i + 2])
+	if redis.call('HEXISTS', KEYS[1], 'item:' .. ARGV[i]) == 0 then
+		local position = redis.call('HINCRBY', KEYS[1], 'item_seq', 1)
+		redis.call('HMSET', KEYS[1], 'item:' .. ARGV[i], ARGV[i + 1], 'pos:' .. ARGV[i], position)
+		index(owner, ARGV[i], i + 3, last)
+		added[#added + 1] = 1
+		changed = true
+	else
+		added[#added + 1] = 0
+	end
+	i = last + 1
+end
+if changed then
+	redis.call('HINCRBY', KEYS[1], 'version', 1)
+	redis.call('PUBLISH', '%(channel)s', KEYS[1])
+end
+return {'ok', redis.call('HGETALL', KEYS[1]), added}
+"""
+
+# ARGV: item_id, encoded item, search terms...
+SCRIPTS['update_item'] = SEARCH_INDEX + CHECK_WISHLIST + """
+if redis.call('HEXISTS', KEYS[1], 'item:' .. ARGV[1]) == 0 then
+	return {'no_item'}
+end
+local owner = redis.call('HGET', KEYS[1], 'owner')
+unindex(owner, ARGV[1])
+redis.call('HSET', KEYS[1], 'item:' .. ARGV[1], ARGV[2])
+index(owner, ARGV[1], 3)
+redis.call('HINCRBY', KEYS[1], 'version', 1)
+redis.call('PUBLISH', '%(channel)s', KEYS[1])
+return {'ok', redis.call('HGETALL', KEYS[1])}
+"""
+
+# ARGV: item_id
+SCRIPTS['remove_item'] = SEARCH_INDEX + CHECK_WISHLIST + """
+unindex(redis.call('HGET', KEYS[1], 'owner'), ARGV[1])
+if redis.call('HDEL', KEYS[1], 'item:' .. ARGV[1], 'pos:' .. ARGV[1]) == 0 then
+	return {'no_item'}
+end
+redis.call('HINCRBY', KEYS[1], 'version', 1)
+redis.call('PUBLISH', '%(channel)s', KEYS[1])
+return {'ok'}
+"""
+
+SCRIPTS['clear_items'] = SEARCH_INDEX + CHECK_WISHLIST + """
+local owner = redis.call('HGET', KEYS[1], 'owner')
+for _, field in ipairs(redis.call('HKEYS', KEYS[1])) do
+	if string.sub(field, 1, 5) == 'item:' then
+		unindex(owner, string.sub(field, 6))
+		redis.call('HDEL', KEYS[1], field)
+	elseif string.sub(field, 1, 4) == 'pos:' then
+		redis.call('HDEL', KEYS[1], field)
+	end
+end
+redis.call('HINCRBY', KEYS[1], 'version', 1)
+redis.call('PUBLISH', '%(channel)s', KEYS[1])
+return {'ok', redis.call('HGETALL', KEYS[1])}
+"""
+
+# Drops the items of the wishlist and their search index entries, or the
+# whole value when the wishlist is still stored as a single blob, keeping
+# the version so that it keeps growing when the items are written again.
+SCRIPTS['reset_items'] = SEARCH_INDEX + """
+local kind = redis.call('TYPE', KEYS[1])['ok']
+if kind == 'hash' then
+	local owner = redis.call('HGET', KEYS[1], 'owner')
+	for _, field in ipairs(redis.call('HKEYS', KEYS[1])) do
+		if string.sub(field, 1, 4) == 'tok:' then
+			unindex(owner, string.sub(field, 5))
+		elseif string.sub(field, 1, 4) == 'pos:' or string.sub(field, 1, 5) == 'item:' then
+			redis.call('HDEL', KEYS[1], field)
+		end
+	end
+elseif kind ~= 'none' then
+	redis.call('DEL', KEYS[1])
+end
+return 1
+"""
+
+# Moves the search index entries of every item of the wishlist to the user in
+# ARGV[1], or drops them and the terms stored in the wishlist when it is ''.
+SCRIPTS['move_search_index'] = """
+if redis.call('TYPE', KEYS[1])['ok'] ~= 'hash' then
+	return 0
+end
+local owner = redis.call('HGET', KEYS[1], 'owner')
+for _, field in ipairs(redis.call('HKEYS', KEYS[1])) do
+	if string.sub(field, 1, 4) == 'tok:' then
+		local member = KEYS[1] .. ':' .. string.sub(field, 5)
+		for term in string.gmatch(redis.call('HGET', KEYS[1], field), '%S+') do
+			redis.call('SREM', 'search:' .. owner .. ':' .. term, member)
+			if ARGV[1] ~= '' then
+				redis.call('SADD', 'search:' .. ARGV[1] .. ':' .. term, member)
+			end
+		end
+		if ARGV[1] == '' then
+			redis.call('HDEL', KEYS[1], field)
+		end
+	end
+end
+return 1
+"""
+
+# the scripts announce their writes to the caches of every process
+for name in SCRIPTS:
+	SCRIPTS[name] = SCRIPTS[name].replace('%(channel)s', Wishlist.CACHE_CHANNEL)
+
+
+######################################################################
+#  P Y T H O N   F A L L B A C K S
+#   The scripts above written against the storage backend, for the
+#   backends that cannot run Lua. They are run with the store locked,
+#   get KEYS and ARGV as strings and answer like their Lua version.
+######################################################################
+
+FALLBACKS = {}
+
+def fallback(name):
+	def register(function):
+		FALLBACKS[name] = function
+		return function
+	return register
+
+def unindex(db, key, owner, item_id):
+	terms = db.hget(key, 'tok:' + item_id)
+	if terms is not None:
+		for term in terms.split():
+			db.srem('search:%s:%s' % (owner, term), '%s:%s' % (key, item_id))
+		db.hdel(key, 'tok:' + item_id)
+
+def index(db, key, owner, item_id, terms):
+	for term in terms:
+		db.sadd('search:%s:%s' % (owner, term), '%s:%s' % (key, item_id))
+	db.hset(key, 'tok:' + item_id, ' '.join(terms))
+
+def check_wishlist(db, key):
+	kind = db.type(key)
+	if kind == 'none':
+		return ['missing']
+	elif kind != 'hash':
+		return ['legacy']
+
+def flat_hash(db, key):
+	return [value for field in db.hgetall(key).iteritems() for value in field]
+
+def changed(db, key):
+	db.hincrby(key, 'version', 1)
+	db.publish(Wishlist.CACHE_CHANNEL, key)
+
+@fallback('compare_and_set')
+def compare_and_set(db, keys, argv):
+	replaced = 0
+	for i in range(0, len(argv), 3):
+		if db.hget(keys[0], argv[i]) == argv[i + 1]:
+			db.hset(keys[0], argv[i], argv[i + 2])
+			replaced += 1
+	if replaced > 0:
+		db.publish(Wishlist.CACHE_CHANNEL, keys[0])
+	return replaced
+
+@fallback('add_item')
+def add_item(db, keys, argv):
+	return add_items(db, keys, argv[:2] + [str(len(argv) - 2)] + argv[2:])[:2]
+
+@fallback('add_items')
+def add_items(db, keys, argv):
+	key = keys[0]
+	status = check_wishlist(db, key)
+	if status:
+		return status
+	owner = db.hget(key, 'owner')
+	added = []
+	i = 0
+	while i < len(argv):
+		item_id, item, terms = argv[i], argv[i + 1], argv[i + 3:i + 3 + int(argv[i + 2])]
+		if not db.hexists(key, 'item:' + item_id):
+			position = db.hincrby(key, 'item_seq', 1)
+			db.hmset(key, {'item:' + item_id: item, 'pos:' + item_id: position})
+			index(db, key, owner, item_id, terms)
+			added.append(1)
+		else:
+			added.append(0)
+		i += 3 + len(terms)
+	if 1 in added:
+		changed(db, key)
+	return ['ok', flat_hash(db, key), added]
+
+@fallback('update_item')
+def update_item(db, keys, argv):
+	key = keys[0]
+	status = check_wishlist(db, key)
+	if status:
+		return status
+	if not db.hexists(key, 'item:' + argv[0]):
+		return ['no_item']
+	owner = db.hget(key, 'owner')
+	unindex(db, key, owner, argv[0])
+	db.hset(key, 'item:' + argv[0], argv[1])
+	index(db, key, owner, argv[0], argv[2:])
+	changed(db, key)
+	return ['ok', flat_hash(db, key)]
+
+@fallback('remove_item')
+def remove_item(db, keys, argv):
+	key = keys[0]
+	status = check_wishlist(db, key)
+	if status:
+		return status
+	unindex(db, key, db.hget(key, 'owner'), argv[0])
+	if db.hdel(key, 'item:' + argv[0], 'pos:' + argv[0]) == 0:
+		return ['no_item']
+	changed(db, key)
+	return ['ok']
+
+@fallback('clear_items')
+def clear_items(db, keys, argv):
+	key = keys[0]
+	status = check_wishlist(db, key)
+	if status:
+		return status
+	owner = db.hget(key, 'owner')
+	for field in db.hkeys(key):
+		if field.startswith('item:'):
+			unindex(db, key, owner, field[5:])
+			db.hdel(key, field)
+		elif field.startswith('pos:'):
+			db.hdel(key, field)
+	changed(db, key)
+	return ['ok', flat_hash(db, key)]
+
+@fallback('reset_items')
+def reset_items(db, keys, argv):
+	key = keys[0]
+	kind = db.type(key)
+	if kind == 'hash':
+		owner = db.hget(key, 'owner')
+		for field in db.hkeys(key):
+			if field.startswith('tok:'):
+				unindex(db, key, owner, field[4:])
+			elif field.startswith('pos:') or field.startswith('item:'):
+				db.hdel(key, field)
+	elif kind != 'none':
+		db.delete(key)
+	return 1
+
+@fallback('move_search_index')
+def move_search_index(db, keys, argv):
+	key = keys[0]
+	if db.type(key) != 'hash':
+		return 0
+	owner = db.hget(key, 'owner')
+	for field in db.hkeys(key):
+		if field.startswith('tok:'):
+			member = '%s:%s' % (key, field[4:])
+			for term in db.hget(key, field).split():
+				db.srem('search:%s:%s' % (owner, term), member)
+				if argv[0] != '':
+					db.sadd('search:%s:%s' % (argv[0], term), member)
+			if argv[0] == '':
+				db.hdel(key, field)
+	return 1
@@ -0,0 +1,301 @@
+import os
+import re
+import sys
+import time
+import random
+import pstats
+import cProfile
+import threading
+from datetime import datetime
+from flask import request
+from . import app
+
+######################################################################
+# Profiling of single requests
+#   Off unless WISHLIST_PROFILE_DIR names a directory to write to. A
+#   request is then profiled when it has an X-Profile: 1 header, or at
+#   random with the probability WISHLIST_PROFILE_RATE (0 by default).
+#   Each profile is written as NAME.pstats, to open with pstats or
+#   snakeviz, and as NAME.collapsed, one "frame;frame;frame micros"
+#   line per stack, for flamegraph.pl or speedscope. Only the
+#   WISHLIST_PROFILE_KEEP newest profiles are kept (100 by default).
+#   Next to it, a sampler thread takes the stacks of the threads that
+#   are answering a request WISHLIST_SAMPLER_HZ times a second (100 by
+#   default, 0 turns it off) and counts them, for a flame graph of all
+#   the requests served since it started.
+######################################################################
+
+HEADER = 'X-Profile'
+PROFILER = 'wishlists.profiling.profiler'
+FORMATS = ['pstats', 'collapsed']
+NAME = re.compile(r'^[0-9T.]+-[0-9]+-[A-Za-z0-9_]+$')
+
+settings = {'directory': None, 'rate': 0.0, 'keep': 100}
+
+# a profiler is running for a request in this thread: the requests of
+# a /batch are profiled as part of it, as only one profiler can run
+profiling = threading.local()
+
+
+def configure(directory=None, rate=0.0, keep=100):
+	""" Turns profiling on when directory is given, creating it, or off """
+	if directory and not os.path.isdir(directory):
+		os.makedirs(directory)
+	settings.update(directory=directory, rate=rate, keep=keep)
+
+
+def configure_from_env():
+	configure(os.getenv('WISHLIST_PROFILE_DIR') or None, float(os.getenv('WISHLIST_PROFILE_RATE', '0')),
+			int(os.getenv('WISHLIST_PROFILE_KEEP', '100')))
+
+
+def enabled():
+	return settings['directory'] is not None
+
+
+def wanted():
+	if request.headers.get(HEADER) == '1':
+		return True
+	return settings['rate'] > 0 and random.random() < settings['rate']
+
+
+@app.before_request
+def start_profiler():
+	if not enabled() or getattr(profiling, 'active', False) or not wanted():
+		return
+	name = '%s-%d-%s' % (datetime.utcnow().strftime('%Y%m%dT%H%M%S.%f'), os.getpid(), request.endpoint or 'unmatched')
+	profiler = cProfile.Profile()
+	request.environ[PROFILER] = (name, profiler)
+	profiling.active = True
+	profiler.enable()
+
+
+@app.after_request
+def tag_response(response):
+	if PROFILER in request.environ:
+		response.headers[HEADER] = request.environ[PROFILER][0]
+	return response
+
+
+@app.teardown_request
+def save_profile(exception):
+	name, profiler = request.environ.pop(PROFILER, (None, None))
+	if profiler is None:
+		return
+	profiler.disable()
+	profiling.active = False
+	try:
+		path = os.path.join(settings['directory'], name)
+		profiler.dump_stats(path + '.pstats')
+		with open(path + '.collapsed', 'w') as collapsed:
+			for stack, micros in sorted(collapsed_stacks(pstats.Stats(profiler).stats).iteritems()):
+				collapsed.write('%s %d\n' % (stack, micros))
+		prune()
+	except (IOError, OSError) as e:
+		app.logger.warn('Could not save the profile %s: %s', name, e)
+
+
+def prune():
+	""" Deletes the profiles older than the newest settings['keep'] """
+	for name in profile_names()[settings['keep']:]:
+		for extension in FORMATS:
+			try:
+				os.remove(os.path.join(settings['directory'], '%s.%s' % (name, extension)))
+			except OSError:
+				pass
+
+
+def profile_names():
+	""" The names of the profiles in the directory, newest first """
+	names = set(os.path.splitext(file_name)[0] for file_name in os.listdir(settings['directory']))
+	return sorted((name for name in names if NAME.match(name)), reverse=True)
+
+
+def profiles():
+	""" Describes the profiles in the directory, newest first """
+	described = []
+	for name in profile_names():
+		created, pid, endpoint = name.split('-', 2)
+		files = dict((extension, '%s.%s' % (name, extension)) for extension in FORMATS
+				if os.path.exists(os.path.join(settings['directory'], '%s.%s' % (name, extension))))
+		described.append({'name': name, 'endpoint': endpoint, 'pid': int(pid), 'files': files,
+				'created': datetime.strptime(created, '%Y%m%dT%H%M%S.%f').isoformat()})
+	return described
+
+
+######################################################################
+# Collapsed stacks
+#   cProfile keeps the time of each function and of each caller to
+#   callee edge, not whole stacks. The stacks are rebuilt by walking the
+#   edges from the functions nobody called, giving each path the share
+#   of the callee's time that its edge accounts for.
+######################################################################
+
+def frame(function):
+	file_name, line, name = function
+	if file_name == '~':
+		return name
+	return '%s (%s:%d)' % (name, '/'.join(file_name.split(os.sep)[-2:]), line)
+
+
+def collapsed_stacks(stats, min_micros=1):
+	""" Returns the microseconds spent in each stack, by "frame;frame;frame" """
+	children = {}
+	for function, (calls, primitive, own, total, callers) in stats.iteritems():
+		for caller, edge in callers.iteritems():
+			children.setdefault(caller, []).append((function, edge[3]))
+	stacks = {}
+
+	def walk(function, path, on_path, share):
+		own, total = stats[function][2], stats[function][3]
+		path = path + [frame(function).replace(';', ':')]
+		micros = own * share * 1e6
+		if micros >= min_micros:
+			stack = ';'.join(path)
+			stacks[stack] = stacks.get(stack, 0) + int(round(micros))
+		for child, edge_total in children.get(function, []):
+			child_total = stats[child][3]
+			if child in on_path or not child_total or edge_total * share * 1e6 < min_micros:
+				continue
+			walk(child, path, on_path | set([child]), share * min(1.0, edge_total / child_total))
+
+	for function, (calls, primitive, own, total, callers) in stats.iteritems():
+		if not [caller for caller in callers if caller in stats]:
+			walk(function, [], set([function]), 1.0)
+	return stacks
+
+
+######################################################################
+# Sampling profiler
+######################################################################
+
+class Sampler(object):
+	"""
+	Counts the stacks of the threads answering a request, sampled by a
+	daemon thread every 1 / hz seconds. Sampling only reads the frames,
+	so the requests are not slowed down but for the time the sampler
+	holds the interpreter lock, which is measured as its overhead.
+	"""
+
+	MAX_STACKS = 10000  # distinct stacks kept, the others count as truncated
+
+	def __init__(self, hz):
+		self.hz = hz
+		self.lock = threading.Lock()
+		self.starting = threading.Lock()
+		self.serving = {}  # requests being answered by thread ident, /batch ones included
+		self.pid = None
+		self.thread = None
+		self.reset()
+		# bound here, as the thread may still run while the interpreter exits
+		self._current_frames = sys._current_frames
+		self._sleep = time.sleep
+		self._clock = time.time
+
+	def reset(self):
+		with self.lock:
+			self.stacks = {}
+			self.samples = 0
+			self.truncated = 0
+			self.started = time.time()
+			self.busy = 0.0
+
+	def ensure_running(self):
+		""" Starts the thread, again in a process forked after it started """
+		if self.hz > 0 and self.pid != os.getpid():
+			with self.starting:
+				if self.pid != os.getpid():
+					# the sampler of the parent may have held the lock when forking
+					self.lock = threading.Lock()
+					self.pid = os.getpid()
+					self.serving = {}
+					self.thread = threading.Thread(target=self.run, name='wishlists-sampler')
+					self.thread.daemon = True
+					self.thread.start()
+
+	def stop(self):
+		self.hz = 0
+		self.pid = None
+
+	def enter(self, ident):
+		self.serving[ident] = self.serving.get(ident, 0) + 1
+
+	def leave(self, ident):
+		depth = self.serving.pop(ident, 1) - 1
+		if depth > 0:
+			self.serving[ident] = depth
+
+	def run(self):
+		pid = self.pid
+		while self.hz > 0 and self.pid == pid:
+			self._sleep(1.0 / self.hz)
+			start = self._clock()
+			self.sample()
+			self.busy += self._clock() - start
+
+	def sample(self):
+		serving = self.serving.keys()
+		if not serving:
+			return
+		frames = self._current_frames()
+		with self.lock:
+			for ident in serving:
+				frame = frames.get(ident)
+				if frame is None:
+					continue
+				codes = []
+				while frame is not None:
+					codes.append(frame.f_code)
+					frame = frame.f_back
+				stack = tuple(codes)
+				if stack in self.stacks:
+					self.stacks[stack] += 1
+				elif len(self.stacks) < self.MAX_STACKS:
+					self.stacks[stack] = 1
+				else:
+					self.truncated += 1
+				self.samples += 1
+
+	def overhead(self):
+		""" The fraction of the time spent sampling since the last reset """
+		elapsed = time.time() - self.started
+		return self.busy / elapsed if elapsed > 0 else 0.0
+
+	def collapsed(self):
+		""" The samples of each stack, by "frame;frame;frame", root first """
+		with self.lock:
+			stacks = self.stacks.items()
+			truncated = self.truncated
+		counts = {}
+		for codes, count in stacks:
+			stack = ';'.join(frame((code.co_filename, code.co_firstlineno, code.co_name)).replace(';', ':')
+					for code in reversed(codes))
+			counts[stack] = counts.get(stack, 0) + count
+		if truncated:
+			counts['[truncated]'] = truncated
+		return counts
+
+
+sampler = Sampler(0)
+
+
+def configure_sampler(hz):
+	""" Samples hz times a second, or stops sampling when hz is 0 """
+	global sampler
+	sampler.stop()
+	sampler = Sampler(hz)
+
+
+@app.before_request
+def sample_request():
+	sampler.ensure_running()
+	sampler.enter(threading.current_thread().ident)
+
+
+@app.teardown_request
+def stop_sampling_request(exception):
+	sampler.leave(threading.current_thread().ident)
+
+
+configure_from_env()
+configure_sampler(float(os.getenv('WISHLIST_SAMPLER_HZ', '100')))
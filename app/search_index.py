@@ -0,0 +1,44 @@
+import re
+
+######################################################################
+# Helpers for the item search index
+#   Items are indexed under every prefix of every word of their id and
+#   description, case folded, so that a query matches the items having,
+#   for each word of the query, a word that starts with it.
+######################################################################
+
+# Longer words are indexed and looked up by their first characters only
+MAX_TERM_LENGTH = 20
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+	""" Splits text into case-folded words """
+	if not isinstance(text, unicode):
+		text = str(text).decode('utf-8', 'replace')
+	return WORD.findall(text.lower())
+
+
+def item_words(item):
+	return tokenize(item['item_id']) + tokenize(item['description'])
+
+
+def index_terms(item):
+	""" Returns the terms an item is indexed under """
+	terms = set()
+	for word in item_words(item):
+		for end in range(1, min(len(word), MAX_TERM_LENGTH) + 1):
+			terms.add(word[:end])
+	return sorted(terms)
+
+
+def query_terms(query):
+	""" Returns the terms to intersect to answer a query """
+	return sorted(set(word[:MAX_TERM_LENGTH] for word in tokenize(query)))
+
+
+def matches(item, query):
+	""" Returns True if every word of the query starts a word of the item """
+	words = item_words(item)
+	return all(any(word.startswith(prefix) for word in words) for prefix in tokenize(query))
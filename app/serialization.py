@@ -0,0 +1,84 @@
+import json
+import pickle
+import msgpack
+
+######################################################################
+# Codecs for the values stored in Redis
+#   Every encoded value starts with a version byte naming the codec
+#   that wrote it, so the codec can be changed without rewriting the
+#   stored data first. Values without a known version byte were written
+#   by pickle, as the service did before codecs were introduced.
+######################################################################
+class Codec(object):
+	""" Base class of the codecs used to store wishlists """
+	name = None
+	version = None
+
+	def encode(self, value):
+		raise NotImplementedError
+
+	def decode(self, data):
+		raise NotImplementedError
+
+	def owns(self, data):
+		""" Returns True if data was written by this codec """
+		return data[:1] == self.version
+
+
+class JSONCodec(Codec):
+	""" Compact JSON, readable from any language """
+	name = 'json'
+	version = '\x01'
+
+	def encode(self, value):
+		return self.version + json.dumps(value, separators=(',', ':'))
+
+	def decode(self, data):
+		return json.loads(data[1:])
+
+
+class MsgPackCodec(Codec):
+	""" MessagePack, the smallest and fastest to decode """
+	name = 'msgpack'
+	version = '\x02'
+
+	def encode(self, value):
+		return self.version + msgpack.packb(value)
+
+	def decode(self, data):
+		return msgpack.unpackb(data[1:], raw=False)
+
+
+class PickleCodec(Codec):
+	""" The format of older releases, only kept to read and roll back """
+	name = 'pickle'
+
+	def encode(self, value):
+		return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+	def decode(self, data):
+		if not ALLOW_PICKLE:
+			raise ValueError('Refusing to load a pickled value')
+		return pickle.loads(data)
+
+	def owns(self, data):
+		return data[:1] not in _BY_VERSION
+
+
+# Set to False once every stored value has been re-encoded
+ALLOW_PICKLE = True
+
+CODECS = dict((codec.name, codec) for codec in [JSONCodec(), MsgPackCodec(), PickleCodec()])
+_BY_VERSION = dict((codec.version, codec) for codec in CODECS.itervalues() if codec.version)
+
+
+def get_codec(name):
+	try:
+		return CODECS[name]
+	except KeyError:
+		raise ValueError('Unknown codec %s, expected one of %s' % (name, ', '.join(sorted(CODECS))))
+
+
+def decode(data):
+	""" Decodes a value written by any of the codecs """
+	return _BY_VERSION.get(data[:1], CODECS['pickle']).decode(data)
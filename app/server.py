@@ -1,20 +1,24 @@
 import os
 import logging
-from redis import Redis
 from redis.exceptions import ConnectionError
-from flask import Flask, Response, jsonify, request, json, url_for, make_response
+from flask import Flask, Response, jsonify, request, json, url_for, make_response, stream_with_context, send_from_directory
 from flask_api import status    # HTTP Status Codes
-from werkzeug.exceptions import NotFound
+from werkzeug.exceptions import NotFound, HTTPException
 from flasgger import Swagger
 from custom_exceptions import WishlistException, ItemException
 from models import Wishlist
+from cache import LRUCache
+from storage import RedisBackend, MemoryBackend, InstrumentedBackend
 from . import app
 
 import json
+from urlparse import urlparse
 from datetime import datetime
 # Error handlers require app to be initialized so we must import
 # then only after we have initialized the Flask app instance
 import error_handlers
+import metrics
+import profiling
 
 redis = None
 
@@ -90,6 +94,9 @@ def add_wishlist():
                     item_description:
                       type: string
                       description: Description of the item
+                    position:
+                      type: integer
+                      description: Insertion order of the item in the wishlist
               description: Dictionary to store objects in a wishlist
             id:
               type: integer
@@ -174,6 +181,9 @@ def add_item_to_wishlist(wishlist_id):
                     item_description:
                       type: string
                       description: Description of the item
+                    position:
+                      type: integer
+                      description: Insertion order of the item in the wishlist
               description: Dictionary to store objects in a wishlist
             id:
               type: integer
@@ -184,9 +194,7 @@ def add_item_to_wishlist(wishlist_id):
 	data = request.get_json()
 	if is_valid(data,'item'):
 		try:
-			wl = Wishlist.find_or_404(wishlist_id)
-			wl.deserialize_wishlist_items(data)
-			wl.save_item()
+			wl = Wishlist.store_item(wishlist_id, data)
 			message = wl.serialize_wishlist()
 			return make_response(jsonify(message), status.HTTP_201_CREATED, {'Location': wl.self_url()})
 		except WishlistException:
@@ -198,14 +206,219 @@ def add_item_to_wishlist(wishlist_id):
 
 
 
+@app.route('/wishlists/batch',methods=['POST'])
+def add_wishlists():
+	"""
+    Creates many Wishlists
+    This endpoint will create a Wishlist for each valid entry of the posted array, all in one write to the database
+    ---
+    tags:
+      - Wishlists
+    consumes:
+      - application/json
+    produces:
+      - application/json
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: array
+          items:
+            schema:
+              id: data
+    responses:
+      201:
+        description: The result of each entry, in the order of the array, with the created Wishlist or the error of the entry
+        schema:
+          type: array
+          items:
+            schema:
+              id: BatchResult
+              properties:
+                status:
+                  type: integer
+                  description: HTTP status of the entry
+                location:
+                  type: string
+                  description: URL of the created Wishlist
+                body:
+                  type: object
+                  description: The created Wishlist, or the error of the entry
+      400:
+        description: Bad Request (the posted data was not an array, or none of its entries was valid)
+    """
+	data = request.get_json()
+	if not isinstance(data, list):
+		message = {'error' : 'Wishlist batch must be an array'}
+		return make_response(jsonify(message), status.HTTP_400_BAD_REQUEST)
+	results = []
+	for wl in create_wishlists(data):
+		if wl is None:
+			results.append(batch_result(status.HTTP_400_BAD_REQUEST, {'error' : 'Wishlist data was not valid'}))
+		else:
+			results.append(batch_result(status.HTTP_201_CREATED, wl.serialize_wishlist(), wl.self_url()))
+	return make_response(json.dumps(results), batch_status(results), {'Content-Type': 'application/json'})
+
+
+@app.route('/wishlists/<int:wishlist_id>/items/batch',methods=['POST'])
+def add_items_to_wishlist(wishlist_id):
+	"""
+    Add many Wishlist Items to an existing wishlist
+    This endpoint will add the valid entries of the posted array to the wishlist, all in one write to the database
+    ---
+    tags:
+      - Wishlist Items
+    consumes:
+      - application/json
+    produces:
+      - application/json
+    parameters:
+      - name: wishlist_id
+        in: path
+        description: ID of wishlist to which the items have to be added to
+        type: integer
+        required: true
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: array
+          items:
+            schema:
+              id: data
+    responses:
+      201:
+        description: The result of each entry, in the order of the array; items already in the wishlist are left unchanged with status 200
+        schema:
+          type: array
+          items:
+            schema:
+              id: BatchResult
+      400:
+        description: Bad Request (the posted data was not an array, or none of its entries was valid)
+      404:
+        description: Wishlist not found
+    """
+	data = request.get_json()
+	if not isinstance(data, list):
+		message = {'error' : 'Item batch must be an array'}
+		return make_response(jsonify(message), status.HTTP_400_BAD_REQUEST)
+	try:
+		wl, added = add_items(wishlist_id, data)
+	except WishlistException:
+		message = { 'error' : 'Wishlist %s was not found' % wishlist_id }
+		return make_response(jsonify(message), status.HTTP_404_NOT_FOUND)
+	results = []
+	for entry, was_added in zip(data, added):
+		if was_added is None:
+			results.append(batch_result(status.HTTP_400_BAD_REQUEST, {'error' : 'Item data was not valid'}))
+		else:
+			code = status.HTTP_201_CREATED if was_added else status.HTTP_200_OK
+			results.append(batch_result(code, wl.items[entry['id']], wl.self_url()))
+	return make_response(json.dumps(results), batch_status(results), {'Content-Type': 'application/json'})
+
+
+@app.route('/batch',methods=['POST'])
+def batch():
+	"""
+    Runs many requests at once
+    This endpoint will run each request of the posted array in order, as if it had been sent on its own, and return all their responses.
+    Consecutive requests creating wishlists, or adding items to the same wishlist, are written to the database together;
+    each item request of such a run is answered with the wishlist as it is after the whole run.
+    ---
+    tags:
+      - Batch
+    consumes:
+      - application/json
+    produces:
+      - application/json
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: array
+          items:
+            schema:
+              id: Operation
+              required:
+                - path
+              properties:
+                method:
+                  type: string
+                  description: HTTP method of the request, GET by default
+                path:
+                  type: string
+                  description: Path of the request, with its query string, e.g. /wishlists/1/items
+                headers:
+                  type: object
+                  description: Headers of the request, e.g. If-None-Match
+                body:
+                  type: object
+                  description: JSON body of the request
+    responses:
+      200:
+        description: The response to each request, in the order of the array
+        schema:
+          type: array
+          items:
+            schema:
+              id: BatchResult
+      400:
+        description: Bad Request (the posted data was not an array of at most 100 requests)
+    """
+	operations = request.get_json()
+	if not isinstance(operations, list) or len(operations) > MAX_BATCH_OPERATIONS:
+		message = {'error' : 'Batch must be an array of at most %d requests' % MAX_BATCH_OPERATIONS}
+		return make_response(jsonify(message), status.HTTP_400_BAD_REQUEST)
+	targets = [operation_target(operation) for operation in operations]
+	results = []
+	start = 0
+	while start < len(operations):
+		end = start + 1
+		if targets[start][0] in COALESCED_ENDPOINTS:
+			while end < len(operations) and targets[end] == targets[start]:
+				end += 1
+		if end - start > 1:
+			results.extend(run_coalesced(targets[start], operations[start:end]))
+		else:
+			results.append(run_operation(operations[start], targets[start]))
+		start = end
+	return make_response(json.dumps(results), status.HTTP_200_OK, {'Content-Type': 'application/json'})
+
+
 @app.route('/wishlists', methods=['GET'])
 def wishlists():
 	"""
     Retrieve a list of Wishlists
-    This endpoint will return all wishlists
+    This endpoint will return all wishlists, or one page of them in id order when limit or cursor is given.
+    With ids, only the wishlists with those ids are returned, together with the ids that were not found.
+    The whole collection is streamed as newline-delimited JSON, one wishlist per line,
+    when the request accepts application/x-ndjson or has stream=1.
     ---
     tags:
       - Wishlists
+    produces:
+      - application/json
+      - application/x-ndjson
+    parameters:
+      - name: ids
+        in: query
+        description: Comma-separated ids of the wishlists to return (at most 1000)
+        type: string
+      - name: stream
+        in: query
+        description: Set to 1 to stream the whole collection as newline-delimited JSON
+        type: integer
+      - name: limit
+        in: query
+        description: Maximum number of wishlists in the page (at most 1000)
+        type: integer
+      - name: cursor
+        in: query
+        description: Opaque cursor of the page to return, taken from the Link header of the previous page
+        type: string
     responses:
       200:
         description: An array of Wishlists
@@ -242,11 +455,54 @@ def wishlists():
                 id:
                   type: integer
                   description: Unique ID of the wishlist assigned internally by the server
+        headers:
+          Link:
+            type: string
+            description: URL of the next page, with rel="next", when the page is not the last
+      400:
+        description: Bad Request (the ids, the limit or the cursor were not valid)
     """
-	wishlistsList = []
-	wishlistsList = Wishlist.all()
+	if 'ids' in request.args:
+		return read_wishlists(request.args['ids'])
+	limit = request.args.get('limit')
+	cursor = request.args.get('cursor')
+	if limit is None and cursor is None:
+		if wants_stream():
+			return Response(stream_with_context(export_wishlists()), status.HTTP_200_OK, mimetype='application/x-ndjson')
+		wishlistsList = Wishlist.all()
+		wishlistsList = [wishlist.serialize_wishlist() for wishlist in wishlistsList]
+		return make_response(json.dumps(wishlistsList, indent=4), status.HTTP_200_OK)
+	try:
+		limit = int(limit or Wishlist.MAX_PAGE_SIZE)
+	except ValueError:
+		limit = 0
+	if not 0 < limit <= Wishlist.MAX_PAGE_SIZE:
+		message = {'error' : 'limit must be between 1 and %d' % Wishlist.MAX_PAGE_SIZE}
+		return make_response(jsonify(message), status.HTTP_400_BAD_REQUEST)
+	wishlistsList, next_cursor = Wishlist.page(cursor, limit)
 	wishlistsList = [wishlist.serialize_wishlist() for wishlist in wishlistsList]
-	return make_response(json.dumps(wishlistsList, indent=4), status.HTTP_200_OK)
+	headers = {}
+	if next_cursor:
+		headers['Link'] = '<%s>; rel="next"' % url_for('wishlists', limit=limit, cursor=next_cursor, _external=True)
+	return make_response(json.dumps(wishlistsList, indent=4), status.HTTP_200_OK, headers)
+
+
+def read_wishlists(ids):
+	""" Returns the wishlists found among comma-separated ids and the ids that were not """
+	try:
+		ids = [int(id) for id in ids.split(',')]
+	except ValueError:
+		ids = []
+	seen = set()
+	ids = [id for id in ids if not (id in seen or seen.add(id))]
+	if not 0 < len(ids) <= Wishlist.MAX_PAGE_SIZE:
+		message = {'error' : 'ids must list between 1 and %d wishlist ids' % Wishlist.MAX_PAGE_SIZE}
+		return make_response(jsonify(message), status.HTTP_400_BAD_REQUEST)
+	found = Wishlist.find_many(ids)
+	found_ids = set(wl.id for wl in found)
+	message = {'wishlists': [wl.serialize_wishlist() for wl in found],
+			'missing': [id for id in ids if id not in found_ids]}
+	return make_response(json.dumps(message, indent=4), status.HTTP_200_OK)
 
 
 @app.route('/wishlists/<int:wishlist_id>', methods=['GET'])
@@ -265,9 +521,13 @@ def read_wishlist(wishlist_id):
         description: ID of wishlist to retrieve
         type: integer
         required: true
+      - name: If-None-Match
+        in: header
+        description: ETag of a version of the wishlist the client already has
+        type: string
     responses:
       200:
-        description: Wishlist retrieved
+        description: Wishlist retrieved, with its version in the ETag header
         schema:
           id: Wishlist
           properties:
@@ -296,16 +556,24 @@ def read_wishlist(wishlist_id):
                     item_description:
                       type: string
                       description: Description of the item
+                    position:
+                      type: integer
+                      description: Insertion order of the item in the wishlist
               description: Dictionary to store objects in a wishlist
             id:
               type: integer
               description: Unique ID of the wishlist assigned internally by the server
+      304:
+        description: Wishlist not modified since the version in If-None-Match
       404:
         description: Wishlist not found
     """
+	version = unchanged_version(wishlist_id)
+	if version is not None:
+		return etag_response(version)
 	try:
 		wl = Wishlist.find_or_404(wishlist_id)
-		return make_response(jsonify(wl.serialize_wishlist()), status.HTTP_200_OK)
+		return etag_response(wl.version, make_response(jsonify(wl.serialize_wishlist()), status.HTTP_200_OK))
 	except WishlistException:
 		return make_response(jsonify(message='Cannot retrieve wishlist with id %s' % wishlist_id), status.HTTP_404_NOT_FOUND)
 
@@ -324,9 +592,13 @@ def item(wishlist_id):
         description: ID of the wishlist from which items have to be retrieved
         required: true
         type: integer
+      - name: If-None-Match
+        in: header
+        description: ETag of a version of the wishlist the client already has
+        type: string
     responses:
       200:
-        description: Wishlist items belonging to the wishlist ID
+        description: Wishlist items belonging to the wishlist ID, with the version of the wishlist in the ETag header
         schema:
         	id: Wishlist
         	properties:
@@ -341,13 +613,18 @@ def item(wishlist_id):
 			  				description: Description of the item
 
 
+      304:
+        description: Wishlist not modified since the version in If-None-Match
       404:
         description: Wishlist not found
     """
+	version = unchanged_version(wishlist_id)
+	if version is not None:
+		return etag_response(version)
 	try:
 		wl = Wishlist.find_or_404(wishlist_id)
 		items = wl.all_items()
-		return make_response(jsonify(items), status.HTTP_200_OK)
+		return etag_response(wl.version, make_response(jsonify(items), status.HTTP_200_OK))
 	except WishlistException:
 		return make_response(jsonify(message='Cannot retrieve wishlist with id %s' % wishlist_id), status.HTTP_404_NOT_FOUND)
 
@@ -461,6 +738,9 @@ def update_wishlist(id):
                     item_description:
                       type: string
                       description: Description of the item
+                    position:
+                      type: integer
+                      description: Insertion order of the item in the wishlist
               description: Dictionary to store objects in a wishlist
             id:
               type: integer
@@ -550,6 +830,9 @@ def update_wishlist_item(wishlist_id, item_id):
                     item_description:
                       type: string
                       description: Description of the item
+                    position:
+                      type: integer
+                      description: Insertion order of the item in the wishlist
               description: Dictionary to store objects in a wishlist
             id:
               type: integer
@@ -567,11 +850,8 @@ def update_wishlist_item(wishlist_id, item_id):
 
 	if is_valid(data, 'item'):
 		try:
-			wl = Wishlist.find_or_404(wishlist_id)
-			wl.update_item(data)
-			wl.save_wishlist()
-			new_wl = wl.find(wishlist_id)
-			return make_response(jsonify(new_wl.serialize_wishlist()), status.HTTP_200_OK)
+			wl = Wishlist.replace_item(wishlist_id, data)
+			return make_response(jsonify(wl.serialize_wishlist()), status.HTTP_200_OK)
 		except WishlistException:
 			message = { 'error' : 'Wishlist %s was not found' % wishlist_id }
 			return make_response(jsonify(message), status.HTTP_404_NOT_FOUND)
@@ -607,13 +887,11 @@ def remove_wishlist_item(wishlist_id, item_id):
       204:
         description: Item deleted
 	"""
-	wl = Wishlist.find(wishlist_id)
-	if not wl:
-		return make_response(jsonify(message='Wishlist with id %d could not be found' % wishlist_id), status.HTTP_204_NO_CONTENT)
 	try:
-		wl.remove_item(item_id)
-		wl.save_wishlist()
+		Wishlist.delete_item(wishlist_id, item_id)
 		return make_response('', status.HTTP_204_NO_CONTENT)
+	except WishlistException:
+		return make_response(jsonify(message='Wishlist with id %d could not be found' % wishlist_id), status.HTTP_204_NO_CONTENT)
 	except ItemException:
 		message = { 'error' : 'Item %s was not found' % item_id }
 		return make_response(jsonify(message), status.HTTP_204_NO_CONTENT)
@@ -668,6 +946,9 @@ def clear_wishlist(wishlist_id):
                     item_description:
                       type: string
                       description: Description of the item
+                    position:
+                      type: integer
+                      description: Insertion order of the item in the wishlist
               description: Dictionary to store objects in a wishlist
             id:
               type: integer
@@ -676,11 +957,8 @@ def clear_wishlist(wishlist_id):
         description: Wishlist not found
     """
 	try:
-		wl = Wishlist.find_or_404(wishlist_id)
-		wl.remove_item(None)
-		wl.save_wishlist()
-		new_wl = wl.find(wishlist_id)
-		return make_response(jsonify(new_wl.serialize_wishlist()), status.HTTP_200_OK)
+		wl = Wishlist.clear_items(wishlist_id)
+		return make_response(jsonify(wl.serialize_wishlist()), status.HTTP_200_OK)
 	except WishlistException:
 		message = { 'error' : 'Wishlist %s was not found' % wishlist_id }
 		return make_response(jsonify(message), status.HTTP_404_NOT_FOUND)
@@ -760,6 +1038,9 @@ def search_wishlists():
                           item_description:
                             type: string
                             description: Description of the item
+                          position:
+                            type: integer
+                            description: Insertion order of the item in the wishlist
       400:
         description: userid is missing
 	"""
@@ -769,18 +1050,272 @@ def search_wishlists():
 	data['uid'] = request.args.get('user_id',None)
 	if data['uid'] is None:
 		return make_response(jsonify("Error: userid is missing"), status.HTTP_400_BAD_REQUEST)
-	wishlists_list = []
 	returned_items = []
-	wishlists_list = Wishlist.all()
-	for wl in wishlists_list:
-		item = wl.search_items(data)
-		if item:
-			returned_items.append(item)
+	for wl, items in Wishlist.search(data['uid'], data['query']):
+		returned_items.append({"Results from wishlist with ID %s" % wl.id : items})
 	message = 'Search results for keyword \"%s\" in wishlists with user ID \"%s\"' % (data['query'], data['uid'])
 	ret = {message : returned_items}
 	return make_response(jsonify(ret), status.HTTP_200_OK)
 
 
+@app.route('/admin/cache', methods=['GET'])
+def cache_stats():
+	"""
+    Retrieve the statistics of the wishlist cache
+    This endpoint will return the hit, miss, eviction and invalidation counters of this process
+    ---
+    tags:
+      - Admin
+    produces:
+      - application/json
+    responses:
+      200:
+        description: Cache statistics, or an empty object when the cache is disabled
+    """
+	return make_response(jsonify(Wishlist.cache_stats() or {}), status.HTTP_200_OK)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_exposition():
+	"""
+    Retrieve the request metrics in the Prometheus text format
+    This endpoint will return the latency histograms, in-progress gauges and payload sizes of every route, added up across the worker processes when PROMETHEUS_MULTIPROC_DIR is set
+    ---
+    tags:
+      - Admin
+    produces:
+      - text/plain
+    responses:
+      200:
+        description: Metrics in the Prometheus exposition format
+    """
+	body, content_type = metrics.exposition()
+	return Response(body, status=status.HTTP_200_OK, content_type=content_type)
+
+
+@app.route('/admin/profiles', methods=['GET'])
+def list_profiles():
+	"""
+    Retrieve the recent request profiles
+    This endpoint will list the profiles written by this server, newest first, with links to their pstats and collapsed stack files. Profiling is on when WISHLIST_PROFILE_DIR is set, for requests with an X-Profile: 1 header or sampled at the rate WISHLIST_PROFILE_RATE
+    ---
+    tags:
+      - Admin
+    produces:
+      - application/json
+    responses:
+      200:
+        description: The profiles, newest first
+      404:
+        description: Profiling is off
+    """
+	if not profiling.enabled():
+		return make_response(jsonify(message='Profiling is off, set WISHLIST_PROFILE_DIR to turn it on'), status.HTTP_404_NOT_FOUND)
+	described = profiling.profiles()
+	for profile in described:
+		profile['files'] = dict((extension, url_for('download_profile', file_name=file_name, _external=True))
+				for extension, file_name in profile['files'].iteritems())
+	return make_response(jsonify(described), status.HTTP_200_OK)
+
+
+@app.route('/admin/profiles/<file_name>', methods=['GET'])
+def download_profile(file_name):
+	"""
+    Retrieve a file of a request profile
+    This endpoint will return a .pstats file, to load with pstats or snakeviz, or a .collapsed file, to draw with flamegraph.pl or speedscope
+    ---
+    tags:
+      - Admin
+    produces:
+      - application/octet-stream
+      - text/plain
+    parameters:
+      - name: file_name
+        in: path
+        description: the name of the file, as listed by /admin/profiles
+        type: string
+        required: true
+    responses:
+      200:
+        description: The file
+      404:
+        description: Profiling is off, or there is no such file
+    """
+	name, extension = os.path.splitext(file_name)
+	if not profiling.enabled() or extension[1:] not in profiling.FORMATS or not profiling.NAME.match(name):
+		return make_response(jsonify(message='Profile %s was not found' % file_name), status.HTTP_404_NOT_FOUND)
+	mimetype = 'text/plain' if extension == '.collapsed' else 'application/octet-stream'
+	return send_from_directory(profiling.settings['directory'], file_name, mimetype=mimetype, as_attachment=True)
+
+
+@app.route('/admin/samples', methods=['GET'])
+def sampled_stacks():
+	"""
+    Retrieve the stacks sampled while answering requests
+    This endpoint will return how many times each stack was sampled since the sampler started or was last reset, one "frame;frame;frame count" line per stack, to draw with flamegraph.pl or speedscope. The sampler runs WISHLIST_SAMPLER_HZ times a second, 100 by default
+    ---
+    tags:
+      - Admin
+    produces:
+      - text/plain
+    parameters:
+      - name: reset
+        in: query
+        description: start counting again after answering
+        type: boolean
+        required: false
+    responses:
+      200:
+        description: The sampled stacks, with the X-Samples and X-Sampler-Overhead headers
+      404:
+        description: The sampler is off
+    """
+	sampler = profiling.sampler
+	if sampler.hz <= 0:
+		return make_response(jsonify(message='The sampler is off, set WISHLIST_SAMPLER_HZ to turn it on'), status.HTTP_404_NOT_FOUND)
+	lines = ['%s %d\n' % stack for stack in sorted(sampler.collapsed().iteritems())]
+	response = Response(''.join(lines), status=status.HTTP_200_OK, mimetype='text/plain')
+	response.headers['X-Samples'] = str(sampler.samples)
+	response.headers['X-Sampler-Overhead'] = '%.5f' % sampler.overhead()
+	if request.args.get('reset') in ['1', 'true']:
+		sampler.reset()
+	return response
+
+
+def unchanged_version(wishlist_id):
+	"""
+	Returns the version of the wishlist if it matches If-None-Match, checking
+	only the version and not reading the wishlist
+	"""
+	if not request.if_none_match:
+		return None
+	version = Wishlist.version_of(wishlist_id)
+	if version is not None and request.if_none_match.contains(str(version)):
+		return version
+	return None
+
+
+def etag_response(version, response=None):
+	""" Tags response with the version of the wishlist, or answers 304 Not Modified """
+	if response is None:
+		response = make_response('', status.HTTP_304_NOT_MODIFIED)
+	response.set_etag(str(version))
+	return response
+
+
+def create_wishlists(entries):
+	""" Saves a wishlist for each valid entry in a single write; invalid entries give None """
+	wishlists = [Wishlist().deserialize_wishlist(entry) if is_valid(entry,'wishlist') else None for entry in entries]
+	Wishlist.save_all([wl for wl in wishlists if wl is not None])
+	return wishlists
+
+
+def add_items(wishlist_id, entries):
+	"""
+	Adds the valid entries to the wishlist in a single write and returns the
+	wishlist and, for each entry, whether it was added or None if it was invalid
+	"""
+	valid = [is_valid(entry,'item') for entry in entries]
+	wl, added = Wishlist.store_items(wishlist_id, [entry for entry, ok in zip(entries, valid) if ok])
+	added = iter(added)
+	return wl, [next(added) if ok else None for ok in valid]
+
+
+def batch_result(code, body, location=None):
+	result = {'status': code, 'body': body}
+	if location:
+		result['location'] = location
+	return result
+
+
+def batch_status(results):
+	""" A batch is created unless every entry of it failed """
+	if results and all(result['status'] >= 400 for result in results):
+		return status.HTTP_400_BAD_REQUEST
+	return status.HTTP_201_CREATED
+
+
+######################################################################
+# Requests of a batch
+#   Each request is routed like a request of its own. Runs of requests
+#   that create wishlists, or add items to the same wishlist, are written
+#   together by COALESCED_ENDPOINTS; the others are dispatched one by one
+#   to their view functions.
+######################################################################
+MAX_BATCH_OPERATIONS = 100
+COALESCED_ENDPOINTS = ['add_wishlist', 'add_item_to_wishlist']
+
+
+def operation_target(operation):
+	""" Returns the endpoint and view arguments a request of a batch is routed to """
+	try:
+		path = urlparse(operation['path']).path
+		method = str(operation.get('method', 'GET')).upper()
+		return app.url_map.bind_to_environ(request.environ).match(path, method)
+	except (HTTPException, KeyError, TypeError, AttributeError):
+		return (None, None)
+
+
+def run_operation(operation, target):
+	""" Dispatches a request of a batch to its view function and returns its result """
+	if target[0] == 'batch':
+		return batch_result(status.HTTP_400_BAD_REQUEST, {'error' : 'Batches cannot be nested'})
+	if not isinstance(operation, dict) or not isinstance(operation.get('path'), basestring):
+		return batch_result(status.HTTP_400_BAD_REQUEST, {'error' : 'Request must have a path'})
+	data = None
+	if operation.get('body') is not None:
+		data = json.dumps(operation['body'])
+	with app.test_request_context(operation['path'], method=str(operation.get('method', 'GET')).upper(),
+			headers=operation.get('headers') or {}, data=data, content_type='application/json'):
+		response = app.full_dispatch_request()
+		response.direct_passthrough = False
+		body = response.get_data()
+	try:
+		body = json.loads(body)
+	except ValueError:
+		pass
+	return batch_result(response.status_code, body, response.headers.get('Location'))
+
+
+def run_coalesced(target, operations):
+	""" Runs requests of a batch that go to the same endpoint and wishlist in a single write """
+	endpoint, args = target
+	entries = [operation.get('body') for operation in operations]
+	results = []
+	if endpoint == 'add_wishlist':
+		for wl in create_wishlists(entries):
+			if wl is None:
+				results.append(batch_result(status.HTTP_400_BAD_REQUEST, {'error' : 'Wishlist data was not valid'}))
+			else:
+				results.append(batch_result(status.HTTP_201_CREATED, wl.serialize_wishlist(), wl.self_url()))
+	else:
+		try:
+			wl, added = add_items(args['wishlist_id'], entries)
+		except WishlistException:
+			wl, added = None, [False if is_valid(entry,'item') else None for entry in entries]
+		for was_added in added:
+			if was_added is None:
+				results.append(batch_result(status.HTTP_400_BAD_REQUEST, {'error' : 'Item data was not valid'}))
+			elif wl is None:
+				message = { 'error' : 'Wishlist %s was not found' % args['wishlist_id'] }
+				results.append(batch_result(status.HTTP_404_NOT_FOUND, message))
+			else:
+				results.append(batch_result(status.HTTP_201_CREATED, wl.serialize_wishlist(), wl.self_url()))
+	return results
+
+
+def wants_stream():
+	if request.args.get('stream') == '1':
+		return True
+	return request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+
+
+def export_wishlists():
+	""" Yields one compact JSON line per wishlist as they are read from Redis """
+	for wishlist in Wishlist.all():
+		yield json.dumps(wishlist.serialize_wishlist(), separators=(',', ':')) + '\n'
+
+
 def is_valid(data, type):
 	valid = False
 	try:
@@ -808,19 +1343,18 @@ def data_load_wishlist(data):
 
 # empty the database
 def data_reset():
-	redis.flushall()
+	Wishlist.remove_all()
 
 def data_load_wishlist_items(data):
 	#data_to_be_sent = {"id":data['id'], "description":data['description']}
-	wl = Wishlist.find_or_404(data['wishlist_id'])
-	wl.deserialize_wishlist_items(data).save_item()
+	Wishlist.store_item(data['wishlist_id'], data)
 
 
 ######################################################################
 # Connect to Redis and catch connection exceptions
 ######################################################################
 def connect_to_redis(hostname, port, password):
-	redis = Redis(host=hostname, port=port, password=password)
+	redis = RedisBackend(host=hostname, port=port, password=password)
 	try:
 		redis.ping()
 	except ConnectionError:
@@ -834,14 +1368,19 @@ def connect_to_redis(hostname, port, password):
 #   1) In Bluemix with Redis bound through VCAP_SERVICES
 #   2) With Redis running on the local server as with Travis CI
 #   3) With Redis --link ed in a Docker container called 'redis'
+#   4) Without Redis, keeping the data in this process, when the
+#      STORAGE_BACKEND environment variable is set to memory
 ######################################################################
 
 def initialize_redis():
 
 	global redis
 	redis = None
+	if os.getenv('STORAGE_BACKEND') == 'memory':
+		app.logger.info("STORAGE_BACKEND is memory, keeping the data in this process")
+		redis = MemoryBackend()
 	# Get the credentials from the Bluemix environment
-	if 'VCAP_SERVICES' in os.environ:
+	elif 'VCAP_SERVICES' in os.environ:
 		app.logger.info("Using VCAP_SERVICES...")
 		VCAP_SERVICES = os.environ['VCAP_SERVICES']
 		services = json.loads(VCAP_SERVICES)
@@ -857,5 +1396,11 @@ def initialize_redis():
 	if not redis:
 		# if you end up here, redis instance is down.
 		app.logger.error('*** FATAL ERROR: Could not connect to the Redis Service')
-	# Have the Wishlist model use Redis
-	Wishlist.use_db(redis)
+	# Have the Wishlist model use Redis, counting its round trips per request
+	Wishlist.use_db(InstrumentedBackend(redis, metrics.record_command) if redis else None)
+	Wishlist.use_codec(os.getenv('WISHLIST_CODEC', 'json'))
+	cache_size = int(os.getenv('WISHLIST_CACHE_SIZE', '1024'))
+	if cache_size > 0:
+		Wishlist.use_cache(LRUCache(cache_size, float(os.getenv('WISHLIST_CACHE_TTL', '5'))))
+	else:
+		Wishlist.use_cache(None)
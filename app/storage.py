@@ -0,0 +1,621 @@
+import os
+import fcntl
+import select
+import timeit
+import fnmatch
+import threading
+from collections import OrderedDict, deque
+from redis import Redis
+from redis.exceptions import ResponseError
+
+######################################################################
+# Storage backends of the models
+#   A backend offers the Redis commands the models use, named, called
+#   and answering as in redis-py, so that the models run unchanged on
+#   Redis or on MemoryBackend, which keeps everything in this process.
+#   Lua scripts are registered together with a Python fallback, which
+#   MemoryBackend runs instead with the whole store locked.
+######################################################################
+class StorageBackend(object):
+	""" The commands a storage backend must offer """
+
+	def ping(self):
+		raise NotImplementedError
+
+	def get(self, name):
+		raise NotImplementedError
+
+	def mget(self, keys, *args):
+		raise NotImplementedError
+
+	def set(self, name, value):
+		raise NotImplementedError
+
+	def delete(self, *names):
+		raise NotImplementedError
+
+	def type(self, name):
+		raise NotImplementedError
+
+	def incr(self, name, amount=1):
+		raise NotImplementedError
+
+	def incrby(self, name, amount=1):
+		raise NotImplementedError
+
+	def scan(self, cursor=0, match=None, count=None):
+		raise NotImplementedError
+
+	def keys(self, pattern='*'):
+		raise NotImplementedError
+
+	def flushall(self):
+		raise NotImplementedError
+
+	def hget(self, name, key):
+		raise NotImplementedError
+
+	def hset(self, name, key, value):
+		raise NotImplementedError
+
+	def hmset(self, name, mapping):
+		raise NotImplementedError
+
+	def hgetall(self, name):
+		raise NotImplementedError
+
+	def hincrby(self, name, key, amount=1):
+		raise NotImplementedError
+
+	def hexists(self, name, key):
+		raise NotImplementedError
+
+	def hdel(self, name, *keys):
+		raise NotImplementedError
+
+	def hkeys(self, name):
+		raise NotImplementedError
+
+	def sadd(self, name, *values):
+		raise NotImplementedError
+
+	def srem(self, name, *values):
+		raise NotImplementedError
+
+	def smembers(self, name):
+		raise NotImplementedError
+
+	def sinter(self, keys, *args):
+		raise NotImplementedError
+
+	def zadd(self, name, *args):
+		""" Takes member, score pairs, in the order of the legacy redis-py Redis class """
+		raise NotImplementedError
+
+	def zrem(self, name, *values):
+		raise NotImplementedError
+
+	def zrangebyscore(self, name, min, max, start=None, num=None):
+		raise NotImplementedError
+
+	def publish(self, channel, message):
+		raise NotImplementedError
+
+	def pubsub(self, **kwargs):
+		raise NotImplementedError
+
+	def pipeline(self, transaction=True):
+		""" Returns an object queuing the commands above until execute(raise_on_error=True) """
+		raise NotImplementedError
+
+	def register_script(self, script, fallback=None):
+		"""
+		Returns a callable running script with (keys=[], args=[], client=None),
+		where client may be a pipeline to queue the script on. fallback is a
+		function(backend, keys, args) doing the same as the Lua script.
+		"""
+		raise NotImplementedError
+
+
+class RedisBackend(Redis, StorageBackend):
+	""" A Redis server """
+
+	def register_script(self, script, fallback=None):
+		return super(RedisBackend, self).register_script(script)
+
+
+def encode(value):
+	""" Turns a key, field or value into the string Redis would store """
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	if isinstance(value, float):
+		return repr(value)
+	return str(value)
+
+
+class SortedSet(dict):
+	""" Scores by member """
+
+
+def wrong_type():
+	return ResponseError('WRONGTYPE Operation against a key holding the wrong kind of value')
+
+
+class MemoryBackend(StorageBackend):
+	"""
+	Keeps the data in this process, for tests and load tests at memory
+	speed. Every command, pipeline and script holds a single lock, so
+	pipelines and scripts are atomic as they are on Redis.
+	"""
+
+	TYPES = [(str, 'string'), (SortedSet, 'zset'), (dict, 'hash'), (set, 'set')]
+
+	def __init__(self):
+		self._lock = threading.RLock()
+		self._data = OrderedDict()
+		self._order = {}  # creation sequence of each key, for SCAN cursors
+		self._sequence = 0
+		self._subscribers = {}
+
+	def _read(self, name, kind):
+		""" Returns the value of name if it is of type kind, or None if there is no such key """
+		value = self._data.get(encode(name))
+		if value is not None and type(value) is not kind:
+			raise wrong_type()
+		return value
+
+	def _write(self, name, kind):
+		""" Returns the value of name, created empty if there is no such key """
+		value = self._read(name, kind)
+		if value is None:
+			value = kind()
+			self._create(encode(name), value)
+		return value
+
+	def _create(self, key, value):
+		self._sequence += 1
+		self._data[key] = value
+		self._order[key] = self._sequence
+
+	def _drop_if_empty(self, name):
+		key = encode(name)
+		if not self._data.get(key, True):
+			self._remove(key)
+
+	def _remove(self, key):
+		del self._data[key]
+		del self._order[key]
+
+	def ping(self):
+		return True
+
+	def get(self, name):
+		with self._lock:
+			return self._read(name, str)
+
+	def mget(self, keys, *args):
+		if isinstance(keys, (basestring, int, long)):
+			keys = [keys]
+		with self._lock:
+			values = [self._data.get(encode(key)) for key in list(keys) + list(args)]
+			return [value if type(value) is str else None for value in values]
+
+	def set(self, name, value):
+		with self._lock:
+			key = encode(name)
+			if key in self._data:
+				self._data[key] = encode(value)
+			else:
+				self._create(key, encode(value))
+			return True
+
+	def delete(self, *names):
+		with self._lock:
+			deleted = 0
+			for key in set(encode(name) for name in names):
+				if key in self._data:
+					self._remove(key)
+					deleted += 1
+			return deleted
+
+	def type(self, name):
+		with self._lock:
+			value = self._data.get(encode(name))
+			if value is None:
+				return 'none'
+			return [kind for cls, kind in self.TYPES if type(value) is cls][0]
+
+	def incr(self, name, amount=1):
+		return self.incrby(name, amount)
+
+	def incrby(self, name, amount=1):
+		with self._lock:
+			value = int(self._read(name, str) or 0) + amount
+			self.set(name, value)
+			return value
+
+	def scan(self, cursor=0, match=None, count=None):
+		"""
+		Returns up to count keys created after cursor; every key that exists
+		during the whole scan is returned exactly once, like Redis does.
+		"""
+		with self._lock:
+			keys = []
+			next_cursor = 0
+			for key in self._data:
+				if self._order[key] <= cursor:
+					continue
+				if len(keys) == (count or 10):
+					next_cursor = self._order[keys[-1]]
+					break
+				keys.append(key)
+			return next_cursor, [key for key in keys if match is None or fnmatch.fnmatchcase(key, match)]
+
+	def keys(self, pattern='*'):
+		with self._lock:
+			return [key for key in self._data if fnmatch.fnmatchcase(key, pattern)]
+
+	def flushall(self):
+		with self._lock:
+			self._data.clear()
+			self._order.clear()
+			return True
+
+	def hget(self, name, key):
+		with self._lock:
+			return (self._read(name, dict) or {}).get(encode(key))
+
+	def hset(self, name, key, value):
+		with self._lock:
+			fields = self._write(name, dict)
+			created = encode(key) not in fields
+			fields[encode(key)] = encode(value)
+			return int(created)
+
+	def hmset(self, name, mapping):
+		with self._lock:
+			fields = self._write(name, dict)
+			for key, value in mapping.iteritems():
+				fields[encode(key)] = encode(value)
+			return True
+
+	def hgetall(self, name):
+		with self._lock:
+			return dict(self._read(name, dict) or {})
+
+	def hincrby(self, name, key, amount=1):
+		with self._lock:
+			value = int(self.hget(name, key) or 0) + amount
+			self.hset(name, key, value)
+			return value
+
+	def hexists(self, name, key):
+		with self._lock:
+			return encode(key) in (self._read(name, dict) or {})
+
+	def hdel(self, name, *keys):
+		with self._lock:
+			fields = self._read(name, dict) or {}
+			deleted = 0
+			for key in set(encode(key) for key in keys):
+				if key in fields:
+					del fields[key]
+					deleted += 1
+			self._drop_if_empty(name)
+			return deleted
+
+	def hkeys(self, name):
+		with self._lock:
+			return list(self._read(name, dict) or {})
+
+	def sadd(self, name, *values):
+		with self._lock:
+			members = self._write(name, set)
+			added = set(encode(value) for value in values) - members
+			members.update(added)
+			return len(added)
+
+	def srem(self, name, *values):
+		with self._lock:
+			members = self._read(name, set) or set()
+			removed = set(encode(value) for value in values) & members
+			members.difference_update(removed)
+			self._drop_if_empty(name)
+			return len(removed)
+
+	def smembers(self, name):
+		with self._lock:
+			return set(self._read(name, set) or set())
+
+	def sinter(self, keys, *args):
+		if isinstance(keys, basestring):
+			keys = [keys]
+		with self._lock:
+			sets = [self._read(key, set) or set() for key in list(keys) + list(args)]
+			return set.intersection(*sets) if sets else set()
+
+	def zadd(self, name, *args):
+		with self._lock:
+			scores = self._write(name, SortedSet)
+			added = 0
+			for member, score in zip(args[::2], args[1::2]):
+				added += encode(member) not in scores
+				scores[encode(member)] = float(score)
+			return added
+
+	def zrem(self, name, *values):
+		with self._lock:
+			scores = self._read(name, SortedSet) or {}
+			removed = 0
+			for key in set(encode(value) for value in values):
+				if key in scores:
+					del scores[key]
+					removed += 1
+			self._drop_if_empty(name)
+			return removed
+
+	def zrangebyscore(self, name, min, max, start=None, num=None):
+		with self._lock:
+			scores = self._read(name, SortedSet) or {}
+			members = sorted((score, member) for member, score in scores.iteritems()
+					if score_above(score, min) and score_below(score, max))
+			members = [member for score, member in members]
+			if start is not None:
+				members = members[start:start + num]
+			return members
+
+	def publish(self, channel, message):
+		with self._lock:
+			subscribers = list(self._subscribers.get(encode(channel), []))
+		for subscriber in subscribers:
+			subscriber.deliver({'type': 'message', 'pattern': None, 'channel': encode(channel), 'data': encode(message)})
+		return len(subscribers)
+
+	def pubsub(self, **kwargs):
+		return MemoryPubSub(self)
+
+	def pipeline(self, transaction=True):
+		return MemoryPipeline(self)
+
+	def register_script(self, script, fallback=None):
+		if fallback is None:
+			raise ValueError('MemoryBackend cannot run Lua scripts without a Python fallback')
+		return MemoryScript(self, fallback)
+
+
+def score_above(score, min):
+	min = str(min)
+	if min.startswith('('):
+		return score > float(min[1:])
+	return score >= float(min)
+
+
+def score_below(score, max):
+	max = str(max)
+	if max.startswith('('):
+		return score < float(max[1:])
+	return score <= float(max)
+
+
+class MemoryPipeline(object):
+	""" Queues commands and runs them together with the store locked """
+
+	def __init__(self, backend):
+		self.backend = backend
+		self.commands = []
+
+	def __len__(self):
+		return len(self.commands)
+
+	def __getattr__(self, name):
+		command = getattr(self.backend, name)
+		def queue(*args, **kwargs):
+			self.commands.append((command, args, kwargs))
+			return self
+		return queue
+
+	def execute(self, raise_on_error=True):
+		commands, self.commands = self.commands, []
+		results = []
+		with self.backend._lock:
+			for command, args, kwargs in commands:
+				try:
+					results.append(command(*args, **kwargs))
+				except ResponseError as e:
+					results.append(e)
+		errors = [result for result in results if isinstance(result, ResponseError)]
+		if errors and raise_on_error:
+			raise errors[0]
+		return results
+
+
+class MemoryScript(object):
+	""" Runs the Python fallback of a script with the store locked """
+
+	def __init__(self, backend, fallback):
+		self.backend = backend
+		self.fallback = fallback
+
+	def __call__(self, keys=[], args=[], client=None):
+		if isinstance(client, MemoryPipeline):
+			client.commands.append((self, (), {'keys': keys, 'args': args}))
+			return client
+		with self.backend._lock:
+			return self.fallback(self.backend, [encode(key) for key in keys], [encode(arg) for arg in args])
+
+
+class MemoryPubSub(object):
+	"""
+	Receives the messages published on a MemoryBackend. Waiting is done on
+	a pipe, like on the socket of a Redis connection, so that listener
+	threads still parked in get_message when the interpreter exits do not
+	run into module globals that are already gone.
+	"""
+
+	def __init__(self, backend, **kwargs):
+		self.backend = backend
+		self.channels = []
+		self.messages = deque()
+		self._wake_up, self._waiting = os.pipe()
+		for fd in self._wake_up, self._waiting:
+			fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+		self._select = select.select
+		self._read = os.read
+
+	def subscribe(self, *channels):
+		with self.backend._lock:
+			for channel in channels:
+				self.backend._subscribers.setdefault(encode(channel), []).append(self)
+				self.channels.append(encode(channel))
+
+	def deliver(self, message):
+		self.messages.append(message)
+		try:
+			os.write(self._waiting, 'x')
+		except OSError:
+			pass  # the pipe is full, a wake up is pending already
+
+	def get_message(self, timeout=0):
+		if not self.messages:
+			self._select([self._wake_up], [], [], timeout)
+		try:
+			self._read(self._wake_up, 4096)
+		except OSError:
+			pass
+		if self.messages:
+			return self.messages.popleft()
+		return None
+
+	def close(self):
+		with self.backend._lock:
+			for channel in self.channels:
+				self.backend._subscribers[channel].remove(self)
+			self.channels = []
+		if self._waiting is not None:
+			os.close(self._wake_up)
+			os.close(self._waiting)
+			self._waiting = None
+
+
+######################################################################
+# Instrumentation
+#   InstrumentedBackend wraps another backend and reports every round
+#   trip to it: a command, a pipeline or a script, with its latency and
+#   the bytes of its arguments and of its reply, to
+#   record(command, seconds, sent, received, commands), where commands
+#   is the number of commands that went in that round trip.
+######################################################################
+# what goes through the wrapper unmeasured, as it is no command or
+# lasts longer than a request
+UNMEASURED = ['pubsub', 'pipeline', 'register_script']
+COMMANDS = frozenset(name for name in vars(StorageBackend) if not name.startswith('_') and name not in UNMEASURED)
+
+
+def payload_size(value):
+	""" About the bytes value takes on the wire, without the framing of the protocol """
+	kind = type(value)
+	if kind is str:
+		return len(value)
+	if kind is int or kind is long:
+		return len(str(value))
+	if kind is tuple or kind is list:
+		return sum(map(payload_size, value))
+	if isinstance(value, dict):
+		return sum(map(payload_size, value)) + sum(map(payload_size, value.itervalues()))
+	if isinstance(value, (list, tuple, set, frozenset)):
+		return sum(map(payload_size, value))
+	if value is None or isinstance(value, Exception):
+		return 0
+	return len(encode(value))
+
+
+class InstrumentedBackend(object):
+	""" Measures the commands, pipelines and scripts sent to backend """
+
+	def __init__(self, backend, record):
+		self.backend = backend
+		self.record = record
+
+	def __getattr__(self, name):
+		attribute = getattr(self.backend, name)
+		if name not in COMMANDS:
+			return attribute
+		command = name.upper()
+		def measured(*args, **kwargs):
+			sent = payload_size(args) + (payload_size(kwargs.values()) if kwargs else 0)
+			start = timeit.default_timer()
+			result = None
+			try:
+				result = attribute(*args, **kwargs)
+				return result
+			finally:
+				self.record(command, timeit.default_timer() - start, sent, payload_size(result), 1)
+		return measured
+
+	def pipeline(self, transaction=True):
+		return InstrumentedPipeline(self.backend.pipeline(transaction=transaction), self.record)
+
+	def register_script(self, script, fallback=None):
+		name = fallback.__name__ if fallback is not None else 'script'
+		return InstrumentedScript(self.backend.register_script(script, fallback), 'EVALSHA ' + name, self.record)
+
+
+class InstrumentedPipeline(object):
+	""" Measures the commands queued on pipeline as the one round trip of execute() """
+
+	def __init__(self, pipeline, record):
+		self.pipeline = pipeline
+		self.record = record
+		self.sent = 0
+		self.commands = 0
+
+	def __len__(self):
+		return len(self.pipeline)
+
+	def __getattr__(self, name):
+		attribute = getattr(self.pipeline, name)
+		if name not in COMMANDS:
+			return attribute
+		def queue(*args, **kwargs):
+			self.queued(payload_size(args) + (payload_size(kwargs.values()) if kwargs else 0))
+			attribute(*args, **kwargs)
+			return self
+		return queue
+
+	def queued(self, sent):
+		self.sent += sent
+		self.commands += 1
+
+	def execute(self, raise_on_error=True):
+		sent, commands = self.sent, self.commands
+		self.sent = self.commands = 0
+		start = timeit.default_timer()
+		result = None
+		try:
+			result = self.pipeline.execute(raise_on_error=raise_on_error)
+			return result
+		finally:
+			self.record('PIPELINE', timeit.default_timer() - start, sent, payload_size(result), commands)
+
+
+class InstrumentedScript(object):
+	""" Measures the calls of a script, or queues them on an InstrumentedPipeline """
+
+	def __init__(self, script, command, record):
+		self.script = script
+		self.command = command
+		self.record = record
+
+	def __call__(self, keys=[], args=[], client=None):
+		sent = payload_size(keys) + payload_size(args)
+		if isinstance(client, InstrumentedPipeline):
+			client.queued(sent)
+			self.script(keys=keys, args=args, client=client.pipeline)
+			return client
+		start = timeit.default_timer()
+		result = None
+		try:
+			result = self.script(keys=keys, args=args, client=client)
+			return result
+		finally:
+			self.record(self.command, timeit.default_timer() - start, sent, payload_size(result), 1)
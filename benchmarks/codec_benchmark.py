@@ -0,0 +1,60 @@
+import sys
+import json
+import pickle
+import timeit
+import argparse
+from app import serialization
+
+######################################################################
+# Compares the codecs used to store wishlists
+# Encodes the fields of one wishlist the way the model stores them
+# (the metadata and each item separately) and reports, per codec, the
+# time to encode and decode the whole wishlist and its size in bytes.
+#   PYTHONPATH=. python benchmarks/codec_benchmark.py --items 100
+######################################################################
+
+def make_fields(items):
+	meta = {'name': u'birthday wishlist', 'user_id': u'user1', 'created': '2017-04-01 12:00:00.000000', 'deleted': False}
+	fields = [meta]
+	for i in range(items):
+		fields.append({'item_id': u'item%d' % i, 'description': u'a fairly ordinary description of item number %d' % i})
+	return fields
+
+
+def legacy_pickle(fields):
+	""" Older releases stored the whole wishlist as one pickle, protocol 0 """
+	return pickle.dumps(fields)
+
+
+def run(items, repeat):
+	fields = make_fields(items)
+	results = {}
+	for name, codec in sorted(serialization.CODECS.iteritems()):
+		encoded = [codec.encode(value) for value in fields]
+		encode = min(timeit.repeat(lambda: [codec.encode(value) for value in fields], number=1, repeat=repeat))
+		decode = min(timeit.repeat(lambda: [serialization.decode(data) for data in encoded], number=1, repeat=repeat))
+		results[name] = {'encode_ms': encode * 1000, 'decode_ms': decode * 1000, 'bytes': sum(len(data) for data in encoded)}
+	blob = legacy_pickle(fields)
+	results['pickle-blob'] = {
+		'encode_ms': min(timeit.repeat(lambda: legacy_pickle(fields), number=1, repeat=repeat)) * 1000,
+		'decode_ms': min(timeit.repeat(lambda: pickle.loads(blob), number=1, repeat=repeat)) * 1000,
+		'bytes': len(blob)}
+	return results
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Compare wishlist codecs')
+	parser.add_argument('--items', type=int, nargs='+', default=[10, 100, 1000], help='items per wishlist')
+	parser.add_argument('--repeat', type=int, default=20, help='timing repetitions, the best is kept')
+	parser.add_argument('--json', action='store_true', help='print the results as JSON')
+	args = parser.parse_args()
+
+	report = dict((items, run(items, args.repeat)) for items in args.items)
+	if args.json:
+		json.dump(report, sys.stdout, indent=4, sort_keys=True)
+		sys.exit(0)
+	for items in args.items:
+		print '%d items per wishlist' % items
+		print '  %-12s %12s %12s %10s' % ('codec', 'encode ms', 'decode ms', 'bytes')
+		for name, result in sorted(report[items].iteritems()):
+			print '  %-12s %12.3f %12.3f %10d' % (name, result['encode_ms'], result['decode_ms'], result['bytes'])
@@ -0,0 +1,286 @@
+import os
+import sys
+import json
+import random
+import timeit
+import httplib
+import logging
+import argparse
+import threading
+import subprocess
+from urlparse import urlparse
+
+######################################################################
+# Load test of the REST API
+# Seeds wishlists and items with data_load_wishlist and
+# data_load_wishlist_items, then has several threads send a weighted
+# mix of requests to every route and reports the throughput and the
+# p50/p95/p99 latency of each route as JSON, to compare commits.
+# The requests go to the Flask test client in this process, on the
+# in-memory storage backend by default, or to a running server:
+#   PYTHONPATH=. python benchmarks/http_benchmark.py --requests 5000
+#   PYTHONPATH=. python benchmarks/http_benchmark.py --storage redis
+#   PYTHONPATH=. python benchmarks/http_benchmark.py --url http://localhost:5000
+# A running server is seeded through the Redis server it shares with
+# this process, so --url implies --storage redis.
+######################################################################
+
+WORDS = ['red', 'blue', 'green', 'mug', 'lamp', 'book', 'chair', 'phone', 'case', 'shirt',
+		'socks', 'watch', 'camera', 'kettle', 'pillow', 'poster', 'guitar', 'bottle', 'tent', 'scarf']
+
+
+class Dataset(object):
+	""" What was seeded, to pick the targets of the requests from """
+
+	def __init__(self, wishlists, items, users):
+		self.wishlists = wishlists
+		self.items = items
+		self.users = users
+		self.lock = threading.Lock()
+		self.created = []  # wishlists created by the load, to delete
+
+	def wishlist(self):
+		return random.randint(1, self.wishlists)
+
+	def item(self):
+		return 'item%d' % random.randint(1, self.items)
+
+	def user(self):
+		return 'user%d' % random.randint(1, self.users)
+
+	def take_created(self):
+		with self.lock:
+			return self.created.pop() if self.created else None
+
+	def add_created(self, response):
+		if response[0] == 201:
+			with self.lock:
+				self.created.append(json.loads(response[1])['id'])
+
+
+def description():
+	return ' '.join(random.sample(WORDS, 3))
+
+
+def seed(server, wishlists, items, users):
+	server.data_reset()
+	for i in range(1, wishlists + 1):
+		server.data_load_wishlist({'name': 'wishlist %d' % i, 'user_id': 'user%d' % (i % users + 1)})
+		for j in range(1, items + 1):
+			server.data_load_wishlist_items({'wishlist_id': i, 'id': 'item%d' % j, 'description': description()})
+	return Dataset(wishlists, items, users)
+
+
+######################################################################
+# The mix of requests
+#   Each route is a weight and a function sending one request to it
+#   with send(method, path, body) and returning the response.
+######################################################################
+
+def create_wishlist(send, data):
+	response = send('POST', '/wishlists', {'name': 'load', 'user_id': data.user()})
+	data.add_created(response)
+	return response
+
+def delete_wishlist(send, data):
+	return send('DELETE', '/wishlists/%s' % (data.take_created() or 0))
+
+def search(send, data):
+	return send('GET', '/wishlists/search?q=%s&user_id=%s' % (random.choice(WORDS), data.user()))
+
+ROUTES = {
+	'GET /': (1, lambda send, data: send('GET', '/')),
+	'GET /wishlists': (1, lambda send, data: send('GET', '/wishlists')),
+	'GET /wishlists?stream=1': (1, lambda send, data: send('GET', '/wishlists?stream=1')),
+	'GET /wishlists?limit': (4, lambda send, data: send('GET', '/wishlists?limit=50')),
+	'GET /wishlists?ids': (6, lambda send, data: send('GET', '/wishlists?ids=%s' % ','.join(str(data.wishlist()) for i in range(5)))),
+	'GET /wishlists/<id>': (20, lambda send, data: send('GET', '/wishlists/%d' % data.wishlist())),
+	'GET /wishlists/<id>/items': (10, lambda send, data: send('GET', '/wishlists/%d/items' % data.wishlist())),
+	'GET /wishlists/<id>/items/<item>': (10, lambda send, data: send('GET', '/wishlists/%d/items/%s' % (data.wishlist(), data.item()))),
+	'GET /wishlists/search': (8, search),
+	'POST /wishlists': (4, create_wishlist),
+	'POST /wishlists/batch': (1, lambda send, data: send('POST', '/wishlists/batch', [{'name': 'load', 'user_id': data.user()} for i in range(10)])),
+	'POST /wishlists/<id>/items': (8, lambda send, data: send('POST', '/wishlists/%d/items' % data.wishlist(), {'id': data.item(), 'description': description()})),
+	'POST /wishlists/<id>/items/batch': (2, lambda send, data: send('POST', '/wishlists/%d/items/batch' % data.wishlist(), [{'id': data.item(), 'description': description()} for i in range(10)])),
+	'PUT /wishlists/<id>': (4, lambda send, data: send('PUT', '/wishlists/%d' % data.wishlist(), {'name': 'renamed', 'user_id': data.user()})),
+	'PUT /wishlists/<id>/items/<item>': (6, lambda send, data: send('PUT', '/wishlists/%d/items/%s' % (data.wishlist(), data.item()), {'description': description()})),
+	'PUT /wishlists/<id>/items/clear': (1, lambda send, data: send('PUT', '/wishlists/%s/items/clear' % (data.take_created() or 0))),
+	'DELETE /wishlists/<id>/items/<item>': (4, lambda send, data: send('DELETE', '/wishlists/%d/items/%s' % (data.wishlist(), data.item()))),
+	'DELETE /wishlists/<id>': (3, delete_wishlist),
+	'POST /batch': (2, lambda send, data: send('POST', '/batch', [{'path': '/wishlists/%d' % data.wishlist()} for i in range(5)])),
+	'GET /admin/cache': (1, lambda send, data: send('GET', '/admin/cache')),
+}
+
+
+######################################################################
+# Where the requests go
+#   A target makes a send(method, path, body) function per thread that
+#   returns the status and the body of the response.
+######################################################################
+
+class ClientTarget(object):
+	""" The Flask test client, in this process """
+
+	def __init__(self, app):
+		self.app = app
+
+	def sender(self):
+		client = self.app.test_client()
+		def send(method, path, body=None):
+			data = json.dumps(body) if body is not None else None
+			response = client.open(path, method=method, data=data, content_type='application/json')
+			return response.status_code, response.get_data()
+		return send
+
+
+class HTTPTarget(object):
+	""" A running server, with one keep-alive connection per thread """
+
+	def __init__(self, url):
+		self.url = urlparse(url)
+
+	def sender(self):
+		connection = [None]
+		def send(method, path, body=None):
+			if connection[0] is None:
+				connection[0] = httplib.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=30)
+			try:
+				connection[0].request(method, self.url.path.rstrip('/') + path,
+						json.dumps(body) if body is not None else None, {'Content-Type': 'application/json'})
+				response = connection[0].getresponse()
+				result = response.status, response.read()
+				if response.will_close:
+					connection[0].close()
+					connection[0] = None
+				return result
+			except (httplib.HTTPException, IOError):
+				connection[0].close()
+				connection[0] = None
+				raise
+		return send
+
+
+######################################################################
+# Running the load and summing it up
+######################################################################
+
+def percentile(values, fraction):
+	""" The nearest-rank percentile of sorted values """
+	if not values:
+		return None
+	return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+
+def summarize(latencies, errors, seconds):
+	latencies = sorted(latencies)
+	return {'requests': len(latencies),
+			'errors': errors,
+			'throughput_rps': round(len(latencies) / seconds, 1) if seconds else None,
+			'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+			'p50_ms': round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+			'p95_ms': round(percentile(latencies, 0.95) * 1000, 3) if latencies else None,
+			'p99_ms': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+			'max_ms': round(latencies[-1] * 1000, 3) if latencies else None}
+
+
+def run(target, data, requests, threads, routes=None):
+	"""
+	Sends requests in total from threads, picking each route with its
+	weight, and returns the summary of each route and of all of them.
+	Responses with a 5xx status or that fail are counted as errors.
+	"""
+	routes = dict((name, ROUTES[name]) for name in (routes or ROUTES))
+	names = sorted(routes)
+	weights = [routes[name][0] for name in names]
+	latencies = dict((name, []) for name in names)
+	errors = dict((name, 0) for name in names)
+	remaining = [requests]
+	lock = threading.Lock()
+
+	def work():
+		send = target.sender()
+		while True:
+			with lock:
+				if remaining[0] <= 0:
+					return
+				remaining[0] -= 1
+			name = weighted_choice(names, weights)
+			start = timeit.default_timer()
+			try:
+				failed = routes[name][1](send, data)[0] >= 500
+			except Exception:
+				failed = True
+			elapsed = timeit.default_timer() - start
+			with lock:
+				latencies[name].append(elapsed)
+				errors[name] += failed
+
+	workers = [threading.Thread(target=work) for i in range(threads)]
+	start = timeit.default_timer()
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+	seconds = timeit.default_timer() - start
+	report = {'routes': dict((name, summarize(latencies[name], errors[name], seconds)) for name in names)}
+	report['total'] = summarize(sum(latencies.values(), []), sum(errors.values()), seconds)
+	report['total']['seconds'] = round(seconds, 3)
+	return report
+
+
+def weighted_choice(names, weights):
+	point = random.uniform(0, sum(weights))
+	for name, weight in zip(names, weights):
+		point -= weight
+		if point <= 0:
+			return name
+	return names[-1]
+
+
+def commit():
+	""" The commit benchmarked, to tell the reports apart """
+	try:
+		return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=open(os.devnull, 'w')).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def load_test(url=None, storage='memory', wishlists=200, items=10, users=20, requests=2000, threads=4, routes=None):
+	""" Seeds the data, runs the load and returns the report """
+	os.environ['STORAGE_BACKEND'] = 'redis' if url else storage
+	from app import server
+	server.app.logger.setLevel(logging.CRITICAL)
+	server.initialize_redis()
+	data = seed(server, wishlists, items, users)
+	target = HTTPTarget(url) if url else ClientTarget(server.app)
+	report = run(target, data, requests, threads, routes)
+	report['config'] = {'target': url or 'client', 'storage': os.environ['STORAGE_BACKEND'],
+			'wishlists': wishlists, 'items': items, 'users': users,
+			'requests': requests, 'threads': threads, 'commit': commit()}
+	return report
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Load test the wishlist REST API')
+	parser.add_argument('--url', help='base URL of a running server, instead of the Flask test client')
+	parser.add_argument('--storage', choices=['memory', 'redis'], default='memory', help='storage backend of the test client')
+	parser.add_argument('--wishlists', type=int, default=200, help='wishlists to seed')
+	parser.add_argument('--items', type=int, default=10, help='items to seed per wishlist')
+	parser.add_argument('--users', type=int, default=20, help='users owning the seeded wishlists')
+	parser.add_argument('--requests', type=int, default=2000, help='requests to send in total')
+	parser.add_argument('--threads', type=int, default=4, help='threads sending requests')
+	parser.add_argument('--route', action='append', choices=sorted(ROUTES), help='only load this route, may be repeated')
+	parser.add_argument('--seed', type=int, default=1, help='seed of the random choices')
+	parser.add_argument('--output', help='write the report to this file instead of stdout')
+	args = parser.parse_args(argv)
+
+	random.seed(args.seed)
+	report = load_test(args.url, args.storage, args.wishlists, args.items, args.users, args.requests, args.threads, args.route)
+	output = open(args.output, 'w') if args.output else sys.stdout
+	json.dump(report, output, indent=4, sort_keys=True)
+	output.write('\n')
+	return report
+
+
+if __name__ == '__main__':
+	main()
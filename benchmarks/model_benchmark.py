@@ -0,0 +1,258 @@
+import gc
+import sys
+import json
+import math
+import timeit
+import argparse
+from app.models import Wishlist
+from app.storage import MemoryBackend
+
+######################################################################
+# Micro-benchmarks of the Wishlist model
+# Times the methods of a wishlist with more and more items, and the
+# reads of a user's wishlists with more and more wishlists per user,
+# on the in-memory storage backend so that Redis is not measured.
+# Each operation is reported in microseconds and in objects allocated
+# per call, and is flagged when its time grows faster than the size:
+# when the slope of log(time) over log(size) is above --max-slope.
+#   PYTHONPATH=. python benchmarks/model_benchmark.py --items 10 100 1000 10000 100000
+######################################################################
+
+WORDS = ['red', 'blue', 'green', 'mug', 'lamp', 'book', 'chair', 'phone', 'case', 'shirt']
+
+
+def item(i):
+	return {'item_id': 'item%d' % i, 'description': '%s %s number %d' % (WORDS[i % 10], WORDS[i / 10 % 10], i)}
+
+
+def wishlist_data(items, id=1, user_id='user1'):
+	data = {'name': 'wishlist %d' % id, 'user_id': user_id, 'items': {}}
+	for i in range(1, items + 1):
+		data['items']['item%d' % i] = dict(item(i), position=i)
+	return data
+
+
+def make_wishlist(items, id=1, user_id='user1'):
+	return Wishlist(id).deserialize_wishlist(wishlist_data(items, id, user_id))
+
+
+def use_memory():
+	Wishlist.use_db(MemoryBackend())
+	Wishlist.use_cache(None)
+
+
+######################################################################
+# The operations
+#   Each is a function of the size returning (run, undo): run(i) is the
+#   call measured, undo(i) puts things back as they were, untimed.
+######################################################################
+
+def nothing(i):
+	pass
+
+
+def find_item(items):
+	wl = make_wishlist(items)
+	return lambda i: wl.find_item('item%d' % (i % items + 1)), nothing
+
+
+def update_item(items):
+	wl = make_wishlist(items)
+	return lambda i: wl.update_item({'id': 'item%d' % (i % items + 1), 'description': 'changed'}), nothing
+
+
+def remove_item(items):
+	wl = make_wishlist(items)
+	removed = {}
+	def run(i):
+		removed['item'] = wl.find_item('item%d' % (i % items + 1))
+		wl.remove_item(removed['item']['item_id'])
+	def undo(i):
+		wl.items[removed['item']['item_id']] = removed['item']
+	return run, undo
+
+
+def search_items(items):
+	wl = make_wishlist(items)
+	return lambda i: wl.search_items({'uid': 'user1', 'query': WORDS[i % 10]}), nothing
+
+
+def deserialize_wishlist_items(items):
+	wl = make_wishlist(items)
+	return (lambda i: wl.deserialize_wishlist_items({'id': 'new%d' % i, 'description': 'a new item'}),
+			lambda i: wl.items.pop('new%d' % i))
+
+
+def serialize_wishlist(items):
+	wl = make_wishlist(items)
+	return lambda i: json.dumps(wl.serialize_wishlist()), nothing
+
+
+def save_wishlist(items):
+	use_memory()
+	data = wishlist_data(items)
+	wl = Wishlist(1).deserialize_wishlist(data)
+	# saved with all of its items every time, as after a PUT with items
+	return lambda i: wl.save_wishlist(), lambda i: wl.deserialize_wishlist(data)
+
+
+def find(items):
+	use_memory()
+	make_wishlist(items).save_wishlist()
+	return lambda i: Wishlist.find(1), nothing
+
+
+def store_item(items):
+	use_memory()
+	make_wishlist(items).save_wishlist()
+	return (lambda i: Wishlist.store_item(1, {'id': 'new%d' % i, 'description': 'a new item'}),
+			lambda i: Wishlist.delete_item(1, 'new%d' % i))
+
+
+def user_wishlists(wishlists):
+	use_memory()
+	Wishlist.save_all([make_wishlist(10, id, 'user1') for id in range(1, wishlists + 1)])
+
+
+def find_by_user(wishlists):
+	user_wishlists(wishlists)
+	return lambda i: Wishlist.find_by_user('user1'), nothing
+
+
+def search(wishlists):
+	user_wishlists(wishlists)
+	return lambda i: Wishlist.search('user1', WORDS[i % 10]), nothing
+
+
+# operations on one wishlist, by the number of its items, and whether
+# they go through the storage backend
+ITEM_OPERATIONS = [(find_item, False), (update_item, False), (remove_item, False), (search_items, False),
+		(deserialize_wishlist_items, False), (serialize_wishlist, False),
+		(save_wishlist, True), (find, True), (store_item, True)]
+
+# operations on the wishlists of a user, by their number
+USER_OPERATIONS = [find_by_user, search]
+
+
+######################################################################
+# Measuring
+######################################################################
+
+def measure(operation, size, calls, repeat):
+	"""
+	Returns the best time per call in microseconds and what a call
+	allocates. Python 2 has no tracemalloc, so allocations are told by
+	the bytes of the value a call returns, and by the objects it leaves
+	allocated, as counted by the youngest generation of the collector
+	while it is disabled.
+	"""
+	run, undo = operation(size)
+	result_bytes = deep_size(run(0))
+	undo(0)
+	best = None
+	for attempt in range(repeat):
+		elapsed = 0.0
+		allocated = 0
+		gc.collect()
+		gc.disable()
+		try:
+			for i in range(calls):
+				before = gc.get_count()[0]
+				start = timeit.default_timer()
+				run(i)
+				elapsed += timeit.default_timer() - start
+				allocated += gc.get_count()[0] - before
+				undo(i)
+		finally:
+			gc.enable()
+		if best is None or elapsed < best[0]:
+			best = (elapsed, allocated)
+	return {'us_per_call': round(best[0] / calls * 1e6, 3), 'objects_per_call': round(float(best[1]) / calls, 1),
+			'result_bytes': result_bytes}
+
+
+def deep_size(value, seen=None):
+	""" The bytes taken by value and everything it refers to """
+	seen = seen if seen is not None else set()
+	if id(value) in seen:
+		return 0
+	seen.add(id(value))
+	size = sys.getsizeof(value)
+	if isinstance(value, dict):
+		size += sum(deep_size(key, seen) + deep_size(item, seen) for key, item in value.iteritems())
+	elif isinstance(value, (list, tuple, set)):
+		size += sum(deep_size(item, seen) for item in value)
+	elif hasattr(value, '__dict__'):
+		size += deep_size(value.__dict__, seen)
+	return size
+
+
+def calls_for(size, budget):
+	""" Fewer calls for larger sizes, so that every size takes about as long """
+	return max(3, min(1000, budget / max(size, 1)))
+
+
+def slope(results):
+	""" The least-squares slope of log(time) over log(size) """
+	points = [(math.log(size), math.log(max(result['us_per_call'], 1e-3))) for size, result in results.iteritems()]
+	if len(points) < 2:
+		return None
+	mean_x = sum(x for x, y in points) / len(points)
+	mean_y = sum(y for x, y in points) / len(points)
+	spread = sum((x - mean_x) ** 2 for x, y in points)
+	return sum((x - mean_x) * (y - mean_y) for x, y in points) / spread if spread else None
+
+
+def run(items, storage_items, wishlists, budget, repeat, max_slope):
+	report = {'items_per_wishlist': {}, 'wishlists_per_user': {}, 'scaling': {}}
+	for operation, stored in ITEM_OPERATIONS:
+		sizes = [size for size in items if not stored or size <= storage_items]
+		# the storage backend indexes every word of every item, so fewer calls
+		cost = 100 if stored else 1
+		report['items_per_wishlist'][operation.__name__] = dict(
+				(size, measure(operation, size, calls_for(size * cost, budget), repeat)) for size in sizes)
+	for operation in USER_OPERATIONS:
+		report['wishlists_per_user'][operation.__name__] = dict(
+				(size, measure(operation, size, calls_for(size * 100, budget), repeat)) for size in wishlists)
+	for group in ['items_per_wishlist', 'wishlists_per_user']:
+		for name, results in report[group].iteritems():
+			growth = slope(results)
+			report['scaling'][name] = {'slope': round(growth, 3) if growth is not None else None,
+					'super_linear': growth is not None and growth > max_slope}
+	return report
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Benchmark the Wishlist model as wishlists and users grow')
+	parser.add_argument('--items', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000], help='items per wishlist')
+	parser.add_argument('--storage-items', type=int, default=1000, help='largest wishlist saved to the storage backend')
+	parser.add_argument('--wishlists', type=int, nargs='+', default=[1, 10, 100, 1000], help='wishlists per user')
+	parser.add_argument('--budget', type=int, default=100000, help='calls times size to spend per measure')
+	parser.add_argument('--repeat', type=int, default=3, help='timing repetitions, the best is kept')
+	parser.add_argument('--max-slope', type=float, default=1.2, help='log-log slope above which scaling is flagged')
+	parser.add_argument('--json', action='store_true', help='print the results as JSON')
+	parser.add_argument('--strict', action='store_true', help='exit with 1 when an operation scales super-linearly')
+	args = parser.parse_args(argv)
+
+	report = run(args.items, args.storage_items, args.wishlists, args.budget, args.repeat, args.max_slope)
+	flagged = sorted(name for name, scaling in report['scaling'].iteritems() if scaling['super_linear'])
+	if args.json:
+		json.dump(report, sys.stdout, indent=4, sort_keys=True)
+		sys.stdout.write('\n')
+	else:
+		for group in ['items_per_wishlist', 'wishlists_per_user']:
+			print group.replace('_', ' ')
+			print '  %-28s %10s %14s %12s %14s' % ('operation', 'size', 'us per call', 'objects', 'result bytes')
+			for name, results in sorted(report[group].iteritems()):
+				for size, result in sorted(results.iteritems()):
+					print '  %-28s %10d %14.3f %12.1f %14d' % (name, size, result['us_per_call'], result['objects_per_call'], result['result_bytes'])
+				print '  %-28s %10s %14s' % ('', 'slope', report['scaling'][name]['slope'])
+		for name in flagged:
+			print 'SUPER-LINEAR: %s grows with slope %s' % (name, report['scaling'][name]['slope'])
+	if args.strict and flagged:
+		sys.exit(1)
+	return report
+
+
+if __name__ == '__main__':
+	main()
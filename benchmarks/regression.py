@@ -0,0 +1,135 @@
+import os
+import sys
+import json
+import random
+import timeit
+import argparse
+import http_benchmark
+import model_benchmark
+
+######################################################################
+# Benchmark regression gate
+# Runs the model and the HTTP benchmarks with a small fixed setup and
+# compares each tracked timing with the baseline stored in
+# benchmarks/baseline.json, failing when one got slower than the
+# threshold allows. Timings are scaled by a calibration loop timed on
+# both machines, so a baseline taken on one machine can gate another.
+#   PYTHONPATH=. python benchmarks/regression.py                 # check
+#   PYTHONPATH=. python benchmarks/regression.py --update        # new baseline
+#   BENCHMARK_THRESHOLD=0.5 PYTHONPATH=. python benchmarks/regression.py
+######################################################################
+
+BASELINE_VERSION = 1
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+MODEL_SETUP = {'items': [10, 100, 1000, 10000], 'storage_items': 100, 'wishlists': [1, 10, 100],
+		'budget': 20000, 'repeat': 3, 'max_slope': 1.2}
+HTTP_SETUP = {'wishlists': 100, 'items': 10, 'users': 10, 'requests': 3000, 'threads': 1}
+
+
+def calibrate(repeat=5):
+	""" Microseconds taken by a fixed piece of pure Python work on this machine """
+	def work():
+		total = {}
+		for i in range(20000):
+			total[str(i)] = [i, i * 2]
+		return sorted(total)
+	return min(timeit.repeat(work, number=1, repeat=repeat)) * 1e6
+
+
+def measure():
+	"""
+	Returns the tracked timings, in microseconds, by name, and the
+	operations of the model that scale super-linearly.
+	"""
+	metrics = {}
+	model = model_benchmark.run(**MODEL_SETUP)
+	for group, unit in [('items_per_wishlist', 'items'), ('wishlists_per_user', 'wishlists')]:
+		for name, results in model[group].iteritems():
+			for size, result in results.iteritems():
+				metrics['model %s %d %s' % (name, size, unit)] = result['us_per_call']
+	random.seed(1)
+	http = http_benchmark.load_test(**HTTP_SETUP)
+	for route, summary in http['routes'].iteritems():
+		if summary['requests']:
+			metrics['http %s p50' % route] = summary['p50_ms'] * 1000
+	metrics['http all routes p95'] = http['total']['p95_ms'] * 1000
+	super_linear = sorted(name for name, scaling in model['scaling'].iteritems() if scaling['super_linear'])
+	return metrics, super_linear
+
+
+def compare(baseline, current, threshold, min_change):
+	"""
+	Returns the rows of the comparison, as (name, baseline, current,
+	change, verdict), and whether a timing regressed.
+	"""
+	rows = []
+	regressed = False
+	for name in sorted(set(baseline) | set(current)):
+		if name not in current:
+			rows.append((name, baseline[name], None, None, 'gone'))
+		elif name not in baseline:
+			rows.append((name, None, current[name], None, 'new'))
+		else:
+			change = (current[name] - baseline[name]) / baseline[name] if baseline[name] else 0.0
+			slower = change > threshold and current[name] - baseline[name] > min_change
+			regressed = regressed or slower
+			rows.append((name, baseline[name], current[name], change, 'SLOWER' if slower else 'ok'))
+	return rows, regressed
+
+
+def print_rows(rows, out):
+	out.write('%-58s %14s %14s %9s  %s\n' % ('timing (us)', 'baseline', 'current', 'change', ''))
+	for name, before, after, change, verdict in rows:
+		out.write('%-58s %14s %14s %9s  %s\n' % (name,
+				'%.1f' % before if before is not None else '-',
+				'%.1f' % after if after is not None else '-',
+				'%+.0f%%' % (change * 100) if change is not None else '-',
+				verdict))
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Fail when the benchmarks got slower than the baseline')
+	parser.add_argument('--baseline', default=BASELINE, help='baseline file')
+	parser.add_argument('--update', action='store_true', help='store the results as the new baseline')
+	parser.add_argument('--threshold', type=float, default=float(os.getenv('BENCHMARK_THRESHOLD', '0.25')),
+			help='slowdown tolerated, as a fraction of the baseline (BENCHMARK_THRESHOLD, 0.25 by default)')
+	parser.add_argument('--min-change', type=float, default=5.0, help='slowdowns under this many microseconds are noise')
+	args = parser.parse_args(argv)
+
+	calibration = calibrate()
+	metrics, super_linear = measure()
+	if args.update:
+		baseline = {'version': BASELINE_VERSION, 'commit': http_benchmark.commit(), 'calibration_us': round(calibration, 1),
+				'model_setup': MODEL_SETUP, 'http_setup': HTTP_SETUP,
+				'metrics': dict((name, round(value, 3)) for name, value in metrics.iteritems())}
+		with open(args.baseline, 'w') as baseline_file:
+			json.dump(baseline, baseline_file, indent=4, sort_keys=True)
+			baseline_file.write('\n')
+		print 'Baseline of %d timings written to %s' % (len(metrics), args.baseline)
+		return 0
+
+	with open(args.baseline) as baseline_file:
+		baseline = json.load(baseline_file)
+	if baseline.get('version') != BASELINE_VERSION:
+		sys.stderr.write('%s has version %s, expected %s: run with --update\n' % (args.baseline, baseline.get('version'), BASELINE_VERSION))
+		return 2
+	# express the timings of this machine at the speed of the baseline's
+	scale = baseline['calibration_us'] / calibration
+	current = dict((name, value * scale) for name, value in metrics.iteritems())
+	rows, regressed = compare(baseline['metrics'], current, args.threshold, args.min_change)
+	print 'Compared with the baseline of commit %s, this machine scaled by %.2f, tolerating %+.0f%%' % (
+			baseline.get('commit'), scale, args.threshold * 100)
+	print_rows(rows, sys.stdout)
+	for name in super_linear:
+		print 'SUPER-LINEAR: model %s' % name
+	if regressed or super_linear:
+		print 'FAILED: %d timings slower than the baseline, %d operations scaling super-linearly' % (
+				len([row for row in rows if row[4] == 'SLOWER']), len(super_linear))
+		return 1
+	print 'OK'
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,50 @@
+import os
+import glob
+import tempfile
+import multiprocessing
+
+######################################################################
+# Gunicorn settings of the production server
+#   gunicorn --config gunicorn.conf.py app:app
+#   SERVER_MODE=production python run.py
+# Each worker process connects to Redis after it is forked, so that no
+# connection pool, pub/sub listener or sampler thread is shared with
+# the master or with another worker. The app is loaded by each worker
+# and not by the master, so kill -HUP <master pid> reloads the code:
+# new workers are started and the old ones finish their requests.
+######################################################################
+
+bind = '0.0.0.0:%s' % os.getenv('PORT', '5000')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = 5
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '0'))
+max_requests_jitter = max_requests / 10
+preload_app = False
+accesslog = os.getenv('GUNICORN_ACCESS_LOG', '-')
+errorlog = '-'
+
+# /metrics adds up the values the workers write to this directory
+if not os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+	os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='wishlists-metrics-')
+# imported here, as child_exit runs in a signal handler of the master
+from prometheus_client import multiprocess
+
+
+def on_starting(arbiter):
+	# the values of the workers of an earlier run would be added up too
+	for path in glob.glob(os.path.join(os.environ['PROMETHEUS_MULTIPROC_DIR'], '*.db')):
+		os.remove(path)
+
+
+def post_fork(arbiter, worker):
+	from app import server
+	server.initialize_redis()
+
+
+def child_exit(arbiter, worker):
+	# drops the in-progress gauges of the worker
+	multiprocess.mark_process_dead(worker.pid)
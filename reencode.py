@@ -0,0 +1,20 @@
+import os
+import argparse
+from app import server
+from app.models import Wishlist
+
+######################################################################
+# Re-encodes every stored wishlist with the codec named by WISHLIST_CODEC
+# Safe to run against a live service, typically in the background:
+#   WISHLIST_CODEC=msgpack python reencode.py --pause 0.05 &
+######################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Re-encode stored wishlists with the current codec')
+    parser.add_argument('--batch-size', type=int, default=Wishlist.SCAN_BATCH_SIZE, help='keys read per SCAN step')
+    parser.add_argument('--pause', type=float, default=0.0, help='seconds to sleep between batches')
+    args = parser.parse_args()
+
+    server.initialize_redis()
+    print "Re-encoding wishlists with the %s codec..." % os.getenv('WISHLIST_CODEC', 'json')
+    rewritten = Wishlist.reencode(args.batch_size, args.pause)
+    print "%d fields rewritten" % rewritten
@@ -1,14 +1,24 @@
 import os
-from app import app, server
+import sys
 
 # Pull options from environment
 debug = (os.getenv('DEBUG', 'False') == 'True')
 port = os.getenv('PORT', '5000')
+mode = os.getenv('SERVER_MODE', 'development')
 
 ######################################################################
 #   M A I N
 ######################################################################
 if __name__ == "__main__":
-    print "Wishlist Service Starting..."
-    server.initialize_redis()
-    app.run(host='0.0.0.0', port=int(port), debug=debug)
\ No newline at end of file
+    if mode == 'production':
+        # pre-fork workers set up by gunicorn.conf.py, which load the app
+        # and connect to Redis themselves, so nothing is imported here
+        from gunicorn.app.wsgiapp import run
+        root = os.path.dirname(os.path.abspath(__file__))
+        sys.argv = [sys.argv[0], '--chdir', root, '--config', os.path.join(root, 'gunicorn.conf.py'), 'app:app']
+        run()
+    else:
+        from app import app, server
+        print "Wishlist Service Starting..."
+        server.initialize_redis()
+        app.run(host='0.0.0.0', port=int(port), debug=debug)
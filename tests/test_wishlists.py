@@ -7,11 +7,18 @@
  #coverage report -m --include= /vagrant/app/server.py
 
 import json
+import pickle
 import unittest
 import logging
 import sys
+import threading
+import time
+import shutil
+import tempfile
 sys.path.insert(0, '/vagrant/')
 from app import server
+from app.storage import MemoryBackend
+from app import profiling
 from flask_api import status
 
 class WishlistTestCase(unittest.TestCase):
@@ -44,6 +51,70 @@ class WishlistTestCase(unittest.TestCase):
 		self.assertEqual(resp.status_code, status.HTTP_200_OK)
 		self.assertTrue(len(resp.data) > 0)
 
+	"""
+		This is a test case to check that several wishlists are read at once by id.
+		GET verb is checked here.
+	"""
+	def test_wishlists_by_ids(self):
+		server.data_load_wishlist({"name": "WL2", "user_id": "user2"})
+		self.app.get('/wishlists/2')  # cached
+		resp = self.app.get('/wishlists?ids=2,7,1,2')
+		self.assertEqual(resp.status_code, status.HTTP_200_OK)
+		data = json.loads(resp.data)
+		self.assertEqual([wl['id'] for wl in data['wishlists']], [2, 1])
+		self.assertEqual(data['wishlists'][1]['items']['item1']['description'], 'test item 1')
+		self.assertEqual(data['missing'], [7])
+		for ids in ['', 'one', ','.join(str(id) for id in range(1002))]:
+			resp = self.app.get('/wishlists?ids=%s' % ids)
+			self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+	"""
+		This is a test case to check that all wishlists are streamed in batches without duplicates.
+	"""
+	def test_all_wishlists_in_batches(self):
+		for i in range(5):
+			server.data_load_wishlist({"name": "WL%d" % i, "user_id": "user1"})
+		wishlists = list(server.Wishlist.all(batch_size=2))
+		self.assertEqual(len(wishlists), 6)
+		self.assertEqual(len(set(wl.id for wl in wishlists)), 6)
+
+	"""
+		This is a test case to check that wishlists can be paged through with limit and cursor.
+		GET verb is checked here.
+	"""
+	def test_wishlists_pages(self):
+		for i in range(4):
+			server.data_load_wishlist({"name": "WL%d" % i, "user_id": "user1"})
+		self.app.delete('/wishlists/3')
+		ids = []
+		url = '/wishlists?limit=2'
+		while url:
+			resp = self.app.get(url)
+			self.assertEqual(resp.status_code, status.HTTP_200_OK)
+			page = json.loads(resp.data)
+			self.assertTrue(len(page) <= 2)
+			ids.extend(wl['id'] for wl in page)
+			link = resp.headers.get('Link')
+			url = link[link.index('/wishlists'):link.index('>')] if link else None
+		self.assertEqual(ids, [1, 2, 4, 5])
+		resp = self.app.get('/wishlists?limit=0')
+		self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+		resp = self.app.get('/wishlists?cursor=bogus')
+		self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+	"""
+		This is a test case to check that the whole collection can be streamed as newline-delimited JSON.
+		GET verb is checked here.
+	"""
+	def test_wishlists_stream(self):
+		server.data_load_wishlist({"name": "WL2", "user_id": "user2"})
+		for url, headers in [('/wishlists?stream=1', {}), ('/wishlists', {'Accept': 'application/x-ndjson'})]:
+			resp = self.app.get(url, headers=headers)
+			self.assertEqual(resp.status_code, status.HTTP_200_OK)
+			self.assertEqual(resp.mimetype, 'application/x-ndjson')
+			lines = resp.data.splitlines()
+			self.assertEqual(sorted(json.loads(line)['name'] for line in lines), ['WL1', 'WL2'])
+
 	"""
 		This is a test case to check read a wishlist.
 		GET verb is checked here.
@@ -54,6 +125,114 @@ class WishlistTestCase(unittest.TestCase):
 		data = json.loads(resp.data)
 		self.assertEqual(data['user_id'], 'user1')
 
+	"""
+		This is a test case to check that a wishlist stored as a single pickled blob is read and rewritten as a hash.
+		GET verb is checked here.
+	"""
+	def test_read_legacy_wishlist(self):
+		blob = {"id": 7, "name": "old", "user_id": "user7", "created": "2017-03-01 00:00:00", "deleted": False, "items": {1: {"item_id": "item1", "description": "old item"}}}
+		server.redis.set(7, pickle.dumps(blob))
+		resp = self.app.get('/wishlists/7')
+		self.assertEqual(resp.status_code, status.HTTP_200_OK)
+		data = json.loads(resp.data)
+		self.assertEqual(data['created'], '2017-03-01 00:00:00')
+		self.assertEqual(data['items']['item1']['position'], 1)
+		self.assertEqual(server.redis.type(7), 'hash')
+		self.assertEqual([wl.id for wl in server.Wishlist.find_by_user('user7')], [7])
+
+	"""
+		This is a test case to check that the service runs unchanged on the in-memory storage backend.
+	"""
+	def test_memory_backend(self):
+		server.redis = MemoryBackend()
+		server.Wishlist.use_db(server.redis)
+		server.Wishlist.use_cache(None)
+		server.data_load_wishlist({"name": "WL1", "user_id": "user1", "items": {"item1": {"item_id": "item1", "description": "blue mug", "position": 1}}})
+		server.redis.set(2, pickle.dumps({"id": 2, "name": "old", "user_id": "user1", "created": "2017-03-01 00:00:00", "deleted": False, "items": {}}))
+		batch = [{'id':'item2','description':'red mug'}, {'id':'item2','description':'again'}]
+		resp = self.app.post('/wishlists/2/items/batch', data=json.dumps(batch), content_type='application/json')
+		self.assertEqual([result['status'] for result in json.loads(resp.data)], [201, 200])
+		self.assertEqual(server.redis.type(2), 'hash')
+		resp = self.app.get('/wishlists/search?q=mug&user_id=user1')
+		self.assertEqual(len(json.loads(resp.data).values()[0]), 2)
+		self.app.put('/wishlists/1', data=json.dumps({'name':'WL1','user_id':'user2'}), content_type='application/json')
+		self.assertEqual(server.redis.smembers('search:user2:mug'), set(['1:item1']))
+		self.app.delete('/wishlists/2')
+		for i in range(3):
+			server.data_load_wishlist({"name": "WL%d" % i, "user_id": "user3"})
+		self.assertEqual([wl.id for wl in server.Wishlist.all(batch_size=2)], [1, 2, 3, 4])
+		resp = self.app.get('/wishlists?limit=3')
+		self.assertEqual([wl['id'] for wl in json.loads(resp.data)], [1, 2, 3])
+		self.assertEqual(server.redis.keys('search:user1:*'), [])
+
+	"""
+		This is a test case to check that fields written by another codec are still read and can be re-encoded.
+		GET verb is checked here.
+	"""
+	def test_reencode_wishlist(self):
+		server.redis.hset(1, 'item:item2', pickle.dumps({'item_id': 'item2', 'description': 'pickled item'}))
+		server.redis.hset(1, 'pos:item2', 2)
+		server.Wishlist.use_codec('msgpack')
+		self.assertEqual(server.Wishlist.reencode(), 3)
+		self.assertEqual(server.Wishlist.reencode(), 0)
+		self.assertEqual(server.redis.hget(1, 'item:item2')[0], '\x02')
+		resp = self.app.get('/wishlists/1')
+		self.assertEqual(resp.status_code, status.HTTP_200_OK)
+		data = json.loads(resp.data)
+		self.assertEqual(data['items']['item2']['description'], 'pickled item')
+		self.assertEqual(data['user_id'], 'user1')
+
+	"""
+		This is a test case to check that reads are cached and that writes of any process invalidate the cache.
+		GET verb is checked here.
+	"""
+	def test_read_wishlist_cached(self):
+		# the announcements of the writes made by setUp may still be arriving
+		for attempt in range(20):
+			self.app.get('/wishlists/1')
+			if json.loads(self.app.get('/admin/cache').data)['hits'] > 0:
+				break
+			time.sleep(0.1)
+		self.assertTrue(json.loads(self.app.get('/admin/cache').data)['hits'] > 0)
+		self.app.put('/wishlists/1', data=json.dumps({'name': 'wl2', 'user_id': 'user1'}), content_type='application/json')
+		self.assertEqual(json.loads(self.app.get('/wishlists/1').data)['name'], 'wl2')
+		# a write made by another process is only announced on the channel
+		meta = server.redis.hget(1, 'meta').replace('wl2', 'wl3')
+		server.redis.hset(1, 'meta', meta)
+		server.redis.publish(server.Wishlist.CACHE_CHANNEL, 1)
+		for attempt in range(20):
+			if json.loads(self.app.get('/wishlists/1').data)['name'] == 'wl3':
+				break
+			time.sleep(0.1)
+		self.assertEqual(json.loads(self.app.get('/wishlists/1').data)['name'], 'wl3')
+
+	"""
+		This is a test case to check that a wishlist is tagged with its version and not sent again while unchanged.
+		GET verb is checked here.
+	"""
+	def test_read_wishlist_etag(self):
+		for url in ['/wishlists/1', '/wishlists/1/items']:
+			resp = self.app.get(url)
+			etag = resp.headers['ETag']
+			resp = self.app.get(url, headers={'If-None-Match': etag})
+			self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+			self.assertEqual(resp.headers['ETag'], etag)
+		data = json.dumps({'id':'item2','description':'test item 2'})
+		self.app.post('/wishlists/1/items',data=data,content_type='application/json')
+		resp = self.app.get('/wishlists/1', headers={'If-None-Match': etag})
+		self.assertEqual(resp.status_code, status.HTTP_200_OK)
+		self.assertNotEqual(resp.headers['ETag'], etag)
+		etag = resp.headers['ETag']
+		# replacing the items keeps the version growing
+		new_wl = {'name': 'WL1', 'user_id': 'user1', 'items': {}}
+		self.app.put('/wishlists/1', data=json.dumps(new_wl), content_type='application/json')
+		resp = self.app.get('/wishlists/1', headers={'If-None-Match': etag})
+		self.assertEqual(resp.status_code, status.HTTP_200_OK)
+		self.assertTrue(int(resp.headers['ETag'].strip('"')) > int(etag.strip('"')))
+		self.app.delete('/wishlists/1')
+		resp = self.app.get('/wishlists/1', headers={'If-None-Match': etag})
+		self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
 	"""
 		This is a test case to check whether not found will return if the given wishlist does not exist.
 		GET verb is checked here.
@@ -133,7 +312,8 @@ class WishlistTestCase(unittest.TestCase):
 		resp = self.app.post('/wishlists/1/items',data=data,content_type='application/json')
 		self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
 		new_json = json.loads(resp.data)
-		self.assertEqual(new_json['items']['2']['item_id'],'item3')
+		self.assertEqual(new_json['items']['item3']['item_id'],'item3')
+		self.assertEqual(new_json['items']['item3']['position'],2)
 		#Checking number of items - 2 items 'cause one is created.
 		respTwo = self.app.get('/wishlists/1/items')
 		dataTwo = json.loads(respTwo.data)
@@ -144,6 +324,233 @@ class WishlistTestCase(unittest.TestCase):
 		self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
 		
 
+	"""
+		This is a test case to check that many wishlists are created at once, skipping the invalid ones.
+		POST verb is checked here.
+	"""
+	def test_create_wishlists_batch(self):
+		batch = [{'name':'WL2','user_id':'user2'}, {'name':'WL3'}, {'name':'WL4','user_id':'user2','items':{'item1':{'item_id':'item1','description':'test item 1','position':1}}}]
+		resp = self.app.post('/wishlists/batch', data=json.dumps(batch), content_type='application/json')
+		self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+		results = json.loads(resp.data)
+		self.assertEqual([result['status'] for result in results], [201, 400, 201])
+		self.assertEqual([results[0]['body']['id'], results[2]['body']['id']], [2, 3])
+		resp = self.app.get('/wishlists/3')
+		self.assertEqual(json.loads(resp.data)['items']['item1']['description'], 'test item 1')
+		self.assertEqual(len(server.Wishlist.find_by_user('user2')), 2)
+		resp = self.app.post('/wishlists', data=json.dumps({'name':'WL5','user_id':'user2'}), content_type='application/json')
+		self.assertEqual(json.loads(resp.data)['id'], 4)
+		resp = self.app.post('/wishlists/batch', data=json.dumps({'name':'WL6','user_id':'user2'}), content_type='application/json')
+		self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+	"""
+		This is a test case to check that many items are added to a wishlist at once.
+		POST verb is checked here.
+	"""
+	def test_create_wishlist_items_batch(self):
+		batch = [{'id':'item2','description':'blue mug'}, {'id':'item3'}, {'id':'item1','description':'changed'}, {'id':'item4','description':'red mug'}, {'id':'item2','description':'again'}]
+		resp = self.app.post('/wishlists/1/items/batch', data=json.dumps(batch), content_type='application/json')
+		self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+		results = json.loads(resp.data)
+		self.assertEqual([result['status'] for result in results], [201, 400, 200, 201, 200])
+		self.assertEqual(results[3]['body']['position'], 3)
+		items = json.loads(self.app.get('/wishlists/1/items').data)
+		self.assertEqual(sorted(items.keys()), ['item1', 'item2', 'item4'])
+		self.assertEqual(items['item1']['description'], 'test item 1')
+		self.assertEqual(items['item2']['description'], 'blue mug')
+		resp = self.app.get('/wishlists/search?user_id=user1&q=mug')
+		self.assertEqual(len(json.loads(resp.data).values()[0][0].values()[0]), 2)
+		resp = self.app.post('/wishlists/5/items/batch', data=json.dumps(batch), content_type='application/json')
+		self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+	"""
+		This is a test case to check that a batch of requests is answered like the requests sent one by one.
+		POST verb is checked here.
+	"""
+	def test_batch(self):
+		operations = [{'method':'POST', 'path':'/wishlists', 'body':{'name':'WL2','user_id':'user2'}},
+				{'method':'POST', 'path':'/wishlists', 'body':{'name':'WL3','user_id':'user2'}},
+				{'method':'POST', 'path':'/wishlists/2/items', 'body':{'id':'item1','description':'test item 1'}},
+				{'method':'POST', 'path':'/wishlists/2/items', 'body':{'id':'item2'}},
+				{'method':'POST', 'path':'/wishlists/2/items', 'body':{'id':'item2','description':'test item 2'}},
+				{'method':'POST', 'path':'/wishlists/9/items', 'body':{'id':'item1','description':'test item 1'}},
+				{'path':'/wishlists/2/items'},
+				{'method':'DELETE', 'path':'/wishlists/3'},
+				{'path':'/wishlists?ids=2,3'},
+				{'path':'/wishlists/2', 'headers':{'If-None-Match':'"0"'}},
+				{'path':'/nowhere'},
+				{'method':'POST', 'path':'/batch', 'body':[]},
+				{'method':'GET'}]
+		resp = self.app.post('/batch', data=json.dumps(operations), content_type='application/json')
+		self.assertEqual(resp.status_code, status.HTTP_200_OK)
+		results = json.loads(resp.data)
+		self.assertEqual([result['status'] for result in results], [201, 201, 201, 400, 201, 404, 200, 204, 200, 200, 404, 400, 400])
+		self.assertTrue(results[0]['location'].endswith('/wishlists/2'))
+		self.assertEqual(sorted(results[6]['body'].keys()), ['item1', 'item2'])
+		self.assertEqual(results[8]['body']['missing'], [3])
+		self.assertEqual(results[9]['body']['name'], 'WL2')
+		resp = self.app.post('/batch', data=json.dumps({'path':'/wishlists'}), content_type='application/json')
+		self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+	"""
+		This is a test case to check that every request is counted in the Prometheus metrics of its route and status.
+		GET verb is checked here.
+	"""
+	def test_metrics(self):
+		def count():
+			resp = self.app.get('/metrics')
+			self.assertEqual(resp.status_code, status.HTTP_200_OK)
+			self.assertTrue(resp.headers['Content-Type'].startswith('text/plain'))
+			series = 'http_request_duration_seconds_count{method="GET",route="/wishlists/<int:wishlist_id>",status="200"} '
+			for line in resp.data.splitlines():
+				if line.startswith(series):
+					return float(line[len(series):])
+			return 0.0
+		before = count()
+		self.app.get('/wishlists/1')
+		self.app.get('/wishlists/1')
+		self.app.get('/wishlists/9')
+		self.assertEqual(count(), before + 2)
+		resp = self.app.get('/metrics')
+		self.assertIn('http_requests_in_progress{method="GET",route="/metrics"} 1.0', resp.data)
+		self.assertIn('http_response_size_bytes_count{method="GET",route="/wishlists/<int:wishlist_id>",status="404"}', resp.data)
+
+	"""
+		This is a test case to check that the round trips to the storage are counted per request and per command.
+		GET, PUT and POST verbs are checked here.
+	"""
+	def test_redis_instrumentation(self):
+		server.Wishlist.use_cache(None)
+		resp = self.app.get('/wishlists/1')
+		self.assertEqual(resp.headers['X-Redis-Calls'], '1')
+		self.assertTrue(int(resp.headers['X-Redis-Bytes']) > 0)
+		data = json.dumps({'description':'changed'})
+		resp = self.app.put('/wishlists/1/items/item1', data=data, content_type='application/json')
+		self.assertEqual(resp.headers['X-Redis-Calls'], '1')
+		batch = json.dumps([{'path':'/wishlists/1'}, {'path':'/wishlists/1/items'}, {'path':'/wishlists/9'}])
+		resp = self.app.post('/batch', data=batch, content_type='application/json')
+		self.assertEqual(resp.headers['X-Redis-Calls'], '3')
+		self.assertEqual(self.app.get('/').headers['X-Redis-Calls'], '0')
+		resp = self.app.get('/metrics')
+		self.assertIn('redis_commands_total{command="EVALSHA update_item"}', resp.data)
+		self.assertIn('http_request_redis_calls_count{method="POST",route="/batch"}', resp.data)
+
+	"""
+		This is a test case to check that requests asking for it are profiled, and that their profiles can be downloaded.
+		GET verb is checked here.
+	"""
+	def test_profiling(self):
+		self.assertEqual(self.app.get('/admin/profiles').status_code, status.HTTP_404_NOT_FOUND)
+		self.assertNotIn('X-Profile', self.app.get('/wishlists/1', headers={'X-Profile':'1'}).headers)
+		directory = tempfile.mkdtemp()
+		try:
+			profiling.configure(directory, keep=2)
+			self.assertNotIn('X-Profile', self.app.get('/wishlists/1').headers)
+			for path in ['/wishlists/1', '/wishlists/search?q=test&user_id=user1', '/wishlists']:
+				resp = self.app.get(path, headers={'X-Profile':'1'})
+				self.assertEqual(resp.status_code, status.HTTP_200_OK)
+			self.assertTrue(resp.headers['X-Profile'].endswith('-wishlists'))
+			resp = self.app.get('/admin/profiles')
+			self.assertEqual(resp.status_code, status.HTTP_200_OK)
+			profiles = json.loads(resp.data)
+			self.assertEqual([profile['endpoint'] for profile in profiles], ['wishlists', 'search_wishlists'])
+			resp = self.app.get(profiles[1]['files']['collapsed'])
+			self.assertEqual(resp.status_code, status.HTTP_200_OK)
+			self.assertIn('search_wishlists (app/server.py:', resp.data)
+			self.assertEqual(self.app.get(profiles[1]['files']['pstats']).status_code, status.HTTP_200_OK)
+			self.assertEqual(self.app.get('/admin/profiles/profile.txt').status_code, status.HTTP_404_NOT_FOUND)
+		finally:
+			profiling.configure(None)
+			shutil.rmtree(directory)
+
+	"""
+		This is a test case to check that the sampler counts the stacks of the requests being answered.
+		GET verb is checked here.
+	"""
+	def test_sampler(self):
+		profiling.configure_sampler(0)
+		self.assertEqual(self.app.get('/admin/samples').status_code, status.HTTP_404_NOT_FOUND)
+		profiling.configure_sampler(1000)
+		try:
+			for i in range(200):
+				self.app.get('/wishlists/search?q=test&user_id=user1')
+				resp = self.app.get('/admin/samples')
+				if 'search_wishlists (app/server.py:' in resp.data:
+					break
+			self.assertEqual(resp.status_code, status.HTTP_200_OK)
+			self.assertIn('search_wishlists (app/server.py:', resp.data)
+			self.assertTrue(int(resp.headers['X-Samples']) > 0)
+			self.assertTrue(float(resp.headers['X-Sampler-Overhead']) < 1)
+			self.app.get('/admin/samples?reset=true')
+			self.assertEqual(profiling.sampler.samples, 0)
+		finally:
+			profiling.configure_sampler(0)
+
+	"""
+		This is a test case to check that items are keyed by item id, duplicates are ignored and positions never collide.
+		POST verb is checked here.
+	"""
+	def test_create_wishlist_item_positions(self):
+		for item_id in ['item2', 'item3', 'item2']:
+			data = json.dumps({'id':item_id,'description':'test %s' % item_id})
+			resp = self.app.post('/wishlists/1/items',data=data,content_type='application/json')
+			self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+		items = json.loads(resp.data)['items']
+		self.assertEqual(sorted(items.keys()), ['item1', 'item2', 'item3'])
+		self.app.delete('/wishlists/1/items/item2')
+		data = json.dumps({'id':'item4','description':'test item 4'})
+		resp = self.app.post('/wishlists/1/items',data=data,content_type='application/json')
+		items = json.loads(resp.data)['items']
+		self.assertEqual([items[key]['position'] for key in ['item1', 'item3', 'item4']], [1, 3, 4])
+
+	"""
+		This is a test case to check that adding and removing an item only touches the fields of that item.
+	"""
+	def test_item_fields_in_hash(self):
+		data = json.dumps({'id':'item2','description':'test item 2'})
+		self.app.post('/wishlists/1/items',data=data,content_type='application/json')
+		self.assertEqual(server.redis.hget(1, 'pos:item2'), '2')
+		self.assertEqual(json.loads(server.redis.hget(1, 'item:item2')[1:]), {'item_id': 'item2', 'description': 'test item 2'})
+		self.app.delete('/wishlists/1/items/item2')
+		self.assertFalse(server.redis.hexists(1, 'item:item2'))
+		self.assertFalse(server.redis.hexists(1, 'pos:item2'))
+		self.assertTrue(server.redis.hexists(1, 'item:item1'))
+
+	"""
+		This is a test case to check that concurrent item additions are not lost and get distinct positions.
+	"""
+	def test_concurrent_item_additions(self):
+		def add_items(worker):
+			for i in range(10):
+				server.Wishlist.store_item(1, {'id': 'w%d-%d' % (worker, i), 'description': 'concurrent item'})
+		threads = [threading.Thread(target=add_items, args=(worker,)) for worker in range(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		items = server.Wishlist.find(1).all_items()
+		self.assertEqual(len(items), 41)
+		self.assertEqual(sorted(item['position'] for item in items.values()), range(1, 42))
+
+	"""
+		This is a test case to check that an item can be added to a wishlist still stored as a single blob.
+		POST verb is checked here.
+	"""
+	def test_create_item_in_legacy_wishlist(self):
+		blob = {"id": 7, "name": "old", "user_id": "user7", "created": "2017-03-01 00:00:00", "deleted": False, "items": {}}
+		server.redis.set(7, pickle.dumps(blob))
+		data = json.dumps({'id':'item2','description':'test item 2'})
+		resp = self.app.post('/wishlists/7/items',data=data,content_type='application/json')
+		self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+		self.assertEqual(json.loads(resp.data)['items']['item2']['position'], 1)
+
+	"""
+		This is a test case to check that items stored with the old sequential keys are migrated.
+	"""
+	def test_migrate_legacy_items(self):
+		items = server.Wishlist.migrate_items({2: {'item_id': 'b', 'description': 'B'}, 1: {'item_id': 'a', 'description': 'A'}, 3: {'item_id': 'a', 'description': 'A again'}})
+		self.assertEqual(items, {'a': {'item_id': 'a', 'description': 'A', 'position': 1}, 'b': {'item_id': 'b', 'description': 'B', 'position': 2}})
+
 	"""
 		This is a test case to check whether an item is added to a wishlist out of index.
 		POST verb is checked here.
@@ -227,6 +634,53 @@ class WishlistTestCase(unittest.TestCase):
 		resp = self.app.get('/wishlists/search?q=item&user_id=user1')
 		self.assertEqual(resp.status_code, status.HTTP_200_OK)
 
+	"""
+	This is a testcase to check that search only looks at the wishlists indexed for the user.
+	GET verb checked here.
+	"""
+	def test_search_uses_user_index(self):
+		server.data_load_wishlist({"name": "WL2", "user_id": "user2", "items": {"1": {"item_id": "item2", "description": "test item 2"}}})
+		self.assertEqual([wl.id for wl in server.Wishlist.find_by_user('user2')], [2])
+		new_wl = {'name': 'WL1', 'user_id': 'user2'}
+		resp = self.app.put('/wishlists/1', data=json.dumps(new_wl), content_type='application/json')
+		self.assertEqual(resp.status_code, status.HTTP_200_OK)
+		self.assertEqual(server.Wishlist.find_by_user('user1'), [])
+		self.assertEqual(sorted(wl.id for wl in server.Wishlist.find_by_user('user2')), [1, 2])
+		self.app.delete('/wishlists/2')
+		resp = self.app.get('/wishlists/search?q=item&user_id=user2')
+		data = json.loads(resp.data)
+		results = data.values()[0]
+		self.assertEqual(len(results), 1)
+		self.assertTrue('Results from wishlist with ID 1' in results[0])
+
+	"""
+	This is a testcase to check that search matches word prefixes regardless of case and follows item changes.
+	GET verb checked here.
+	"""
+	def test_search_index(self):
+		data = json.dumps({'id':'item2','description':'Red Bicycle'})
+		self.app.post('/wishlists/1/items',data=data,content_type='application/json')
+		def search(query):
+			resp = self.app.get('/wishlists/search?q=%s&user_id=user1' % query)
+			self.assertEqual(resp.status_code, status.HTTP_200_OK)
+			results = json.loads(resp.data).values()[0]
+			return sorted(item['item_id'] for result in results for items in result.values() for item in items)
+		self.assertEqual(search('bic'), ['item2'])
+		self.assertEqual(search('RED%20bi'), ['item2'])
+		self.assertEqual(search('ite'), ['item1', 'item2'])
+		self.assertEqual(search('bike'), [])
+		data = json.dumps({'description':'Blue Scooter'})
+		self.app.put('/wishlists/1/items/item2',data=data,content_type='application/json')
+		self.assertEqual(search('bic'), [])
+		self.assertEqual(search('scoot'), ['item2'])
+		self.app.delete('/wishlists/1/items/item2')
+		self.assertEqual(search('scoot'), [])
+		self.app.put('/wishlists/1', data=json.dumps({'name': 'WL1', 'user_id': 'user2'}), content_type='application/json')
+		self.assertEqual(search('test'), [])
+		self.assertEqual(server.redis.smembers('search:user2:test'), set(['1:item1']))
+		self.app.delete('/wishlists/1')
+		self.assertEqual(server.redis.keys('search:*'), [])
+
 	"""
 	This is a testcase to search an object not present in the users wishlist.
 	GET verb checked here.
@@ -254,7 +708,7 @@ class WishlistTestCase(unittest.TestCase):
 		resp = self.app.put('/wishlists/1/items/item1', data=data, content_type='application/json')
 		self.assertEqual( resp.status_code, status.HTTP_200_OK )
 		new_json = json.loads(resp.data)
-		self.assertEqual (new_json['items']['1']['description'], 'test update')
+		self.assertEqual (new_json['items']['item1']['description'], 'test update')
 
 	"""
 		This is a test case to check whether an error is returned when empty data is sent for an item.